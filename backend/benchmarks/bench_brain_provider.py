@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Benchmark del cerebro IA con el proveedor local (LLM_PROVIDER=fake)
+
+Lanza peticiones concurrentes contra generate_with_fallback sin red ni cuota y
+reporta throughput, latencias y qué modelo atendió cada llamada. Subiendo
+LLM_FAKE_PRO_QUOTA_RATE se ejercita el rescate Pro→Flash y el cooldown; con
+ROUTER_HEDGE_ENABLED=1 y BENCH_REQUEST_CLASS=interactive, la cobertura con Flash.
+
+Uso (desde backend/):
+    MONGO_URL=... DB_NAME=... LLM_FAKE_PRO_QUOTA_RATE=0.2 python benchmarks/bench_brain_provider.py
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+os.environ["LLM_PROVIDER"] = "fake"
+os.environ.setdefault("LLM_FAKE_SEED", "42")
+os.environ.setdefault("LLM_FAKE_PRO_LATENCY_MS", "300")
+os.environ.setdefault("LLM_FAKE_FLASH_LATENCY_MS", "100")
+os.environ.setdefault("JWT_SECRET", "bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+TOTAL_REQUESTS = int(os.environ.get("BENCH_REQUESTS", 200))
+CONCURRENCY = int(os.environ.get("BENCH_CONCURRENCY", 20))
+REQUEST_CLASS = os.environ.get("BENCH_REQUEST_CLASS", "batch")
+
+
+async def main():
+    prompt = await server.build_analytics_prompt(server.AnalyticsAnalyzeRequest(
+        athlete_name="Bench", fatigue_data=[2, 3, 3], soreness_data=[1, 2, 2],
+        recent_workouts_count=12, recent_prs=["Sentadilla: 120kg"]
+    ))
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies, failures = [], {}
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await server.generate_with_fallback(prompt, request_class=REQUEST_CLASS)
+                latencies.append((time.perf_counter() - start) * 1000)
+            except server.HTTPException as e:
+                failures[e.status_code] = failures.get(e.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(TOTAL_REQUESTS)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"Peticiones: {TOTAL_REQUESTS}  concurrencia: {CONCURRENCY}  tiempo: {elapsed:.2f}s  throughput: {TOTAL_REQUESTS / elapsed:.1f} req/s")
+    if latencies:
+        print(f"Latencia p50: {statistics.median(latencies):.0f} ms  p95: {latencies[int(len(latencies) * 0.95) - 1]:.0f} ms")
+    print(f"Fallos por código HTTP: {failures or 'ninguno'}")
+    for model_id, stats in server.LLM_PROVIDER.stats()["models"].items():
+        print(f"  {model_id}: {stats}")
+    print(f"Decisiones del router: {server.MODEL_ROUTER.stats()['decisions']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la verificación de ID tokens de Google (POST /api/auth/google)
+
+Genera un par de claves RSA local, lo expone al verificador mediante
+GOOGLE_CERTS_FILE (modo test, sin red) y firma tokens con el mismo formato que
+emite Google. Mide la latencia de GoogleTokenVerifier.verify con varias
+peticiones concurrentes y cuánto se retrasa el event loop mientras tanto.
+
+Uso (desde backend/): MONGO_URL=... DB_NAME=... python benchmarks/bench_google_verify.py
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+KEY_ID = "bench-key"
+CONCURRENCY = [1, 10, 50]
+REQUESTS_PER_LEVEL = 200
+
+private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+public_pem = private_key.public_key().public_bytes(
+    serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+).decode("utf-8")
+certs_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+json.dump({KEY_ID: public_pem}, certs_file)
+certs_file.close()
+
+os.environ["GOOGLE_CERTS_FILE"] = certs_file.name
+os.environ.setdefault("JWT_SECRET", "bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+
+def make_token(n: int) -> str:
+    now = datetime.now(timezone.utc)
+    claims = {
+        "iss": "https://accounts.google.com",
+        "aud": server.GOOGLE_CLIENT_ID,
+        "sub": str(n),
+        "email": f"bench_{n}@test.com",
+        "name": "Bench",
+        "iat": now,
+        "exp": now + timedelta(hours=1),
+    }
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": KEY_ID})
+
+
+async def loop_lag_probe(stop: asyncio.Event, samples: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.005)
+        samples.append((time.perf_counter() - start - 0.005) * 1000)
+
+
+async def run_level(concurrency: int):
+    tokens = [make_token(i) for i in range(REQUESTS_PER_LEVEL)]
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, lag = [], []
+
+    async def one(token):
+        async with semaphore:
+            start = time.perf_counter()
+            await server.GOOGLE_VERIFIER.verify(token)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    stop = asyncio.Event()
+    probe = asyncio.create_task(loop_lag_probe(stop, lag))
+    start = time.perf_counter()
+    await asyncio.gather(*(one(t) for t in tokens))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe
+    latencies.sort()
+    print(f"{concurrency:>12}{REQUESTS_PER_LEVEL / elapsed:>12.0f}{statistics.median(latencies):>10.2f}"
+          f"{latencies[int(len(latencies) * 0.95) - 1]:>10.2f}{max(lag) if lag else 0:>14.2f}")
+
+
+async def main():
+    print(f"{'concurrencia':>12}{'verif/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'lag loop ms':>14}")
+    try:
+        for concurrency in CONCURRENCY:
+            await run_level(concurrency)
+        print(f"Descargas de claves: {server.GOOGLE_VERIFIER.stats['cert_fetches']}")
+    finally:
+        os.unlink(certs_file.name)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
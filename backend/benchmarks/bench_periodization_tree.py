@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Benchmark de GET /api/periodization/tree/{athlete_id}
+
+Siembra árboles de periodización de tamaño creciente en una base de datos
+temporal y mide la latencia del handler. Con una consulta por nivel la latencia
+debe mantenerse prácticamente plana aunque crezca el número de micro/macrociclos.
+
+Uso (desde backend/): MONGO_URL=... python benchmarks/bench_periodization_tree.py
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "fit_tracker_bench")
+os.environ.setdefault("JWT_SECRET", "bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+# (macrociclos, microciclos por macro, entrenamientos por micro)
+TREE_SIZES = [(1, 4, 3), (4, 12, 3), (8, 12, 5), (16, 24, 5)]
+ITERATIONS = 20
+
+
+async def seed_tree(athlete_id: str, n_macros: int, n_micros: int, n_workouts: int):
+    macros, micros, workouts = [], [], []
+    for m in range(n_macros):
+        macro_id = str(uuid.uuid4())
+        macros.append({"id": macro_id, "athlete_id": athlete_id, "nombre": f"Macro {m}", "fecha_inicio": "2026-01-01", "fecha_fin": "2026-12-31"})
+        for mi in range(n_micros):
+            micro_id = str(uuid.uuid4())
+            micros.append({"id": micro_id, "macrociclo_id": macro_id, "nombre": f"Micro {mi}", "fecha_inicio": "2026-01-01", "fecha_fin": "2026-01-07", "tipo": "CARGA", "color": "#000"})
+            for w in range(n_workouts):
+                workouts.append({"id": str(uuid.uuid4()), "athlete_id": athlete_id, "microciclo_id": micro_id, "title": f"Sesión {w}", "date": "2026-01-02", "exercises": [{"name": "Sentadilla", "sets": "3", "reps": "10"}], "completed": False})
+    await server.db.macrociclos.insert_many(macros)
+    await server.db.microciclos.insert_many(micros)
+    await server.db.workouts.insert_many(workouts)
+    return len(macros) + len(micros) + len(workouts)
+
+
+async def main():
+    await server.ensure_indexes()
+    user = {"id": "bench-trainer", "role": "trainer"}
+    print(f"{'árbol (macro x micro x sesiones)':<36}{'docs':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    try:
+        for n_macros, n_micros, n_workouts in TREE_SIZES:
+            athlete_id = str(uuid.uuid4())
+            docs = await seed_tree(athlete_id, n_macros, n_micros, n_workouts)
+            await server.get_periodization_tree(athlete_id, user=user)  # calentamiento
+            samples = []
+            for _ in range(ITERATIONS):
+                start = time.perf_counter()
+                result = await server.get_periodization_tree(athlete_id, user=user)
+                samples.append((time.perf_counter() - start) * 1000)
+            assert "error" not in result, result["error"]
+            samples.sort()
+            p95 = samples[int(len(samples) * 0.95) - 1]
+            print(f"{f'{n_macros} x {n_micros} x {n_workouts}':<36}{docs:>8}{statistics.median(samples):>10.1f}{p95:>10.1f}")
+    finally:
+        await server.client.drop_database(os.environ["DB_NAME"])
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
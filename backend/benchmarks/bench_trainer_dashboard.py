@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark de GET /api/trainer/dashboard
+
+Siembra plantillas de 5 a 500 atletas (con sesiones y wellness) en una base de
+datos temporal y compara el panel en una sola llamada con el patrón anterior de
+un /analytics/summary por atleta. El panel hace un número fijo de consultas
+($in/$group), así que su latencia debe crecer muy poco con la plantilla.
+
+Uso (desde backend/): MONGO_URL=... python benchmarks/bench_trainer_dashboard.py
+"""
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "fit_tracker_bench")
+os.environ.setdefault("JWT_SECRET", "bench")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+ROSTER_SIZES = [5, 50, 200, 500]
+WORKOUTS_PER_ATHLETE = 30
+WELLNESS_DAYS = 14
+ITERATIONS = 20
+
+
+async def seed_roster(trainer_id: str, n_athletes: int):
+    today = datetime.now(timezone.utc).date()
+    athletes, workouts, wellness = [], [], []
+    for i in range(n_athletes):
+        athlete_id = str(uuid.uuid4())
+        athletes.append({"id": athlete_id, "email": f"{athlete_id}@bench.local", "name": f"Atleta {i}", "role": "athlete", "trainer_id": trainer_id, "is_injured": i % 10 == 0})
+        for w in range(WORKOUTS_PER_ATHLETE):
+            workouts.append({"id": str(uuid.uuid4()), "athlete_id": athlete_id, "trainer_id": trainer_id, "title": f"Sesión {w}", "date": (today - timedelta(days=w)).isoformat(), "exercises": [], "completed": w > 0 and random.random() < 0.7})
+        for d in range(WELLNESS_DAYS):
+            wellness.append({"id": str(uuid.uuid4()), "athlete_id": athlete_id, "date": (today - timedelta(days=d)).isoformat(), "fatigue": random.randint(1, 5), "soreness": random.randint(1, 5), "stress": random.randint(1, 5), "sleep_quality": random.randint(1, 5), "updated_at": datetime.now(timezone.utc).isoformat()})
+    await server.db.users.insert_many(athletes)
+    await server.db.workouts.insert_many(workouts)
+    await server.db.wellness.insert_many(wellness)
+    return [a["id"] for a in athletes]
+
+
+async def timed(fn, iterations: int = ITERATIONS):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+async def main():
+    await server.ensure_indexes()
+    print(f"{'atletas':<10}{'panel frío ms':>15}{'panel p50':>12}{'panel p95':>12}{'N+1 p50':>12}")
+    try:
+        for n_athletes in ROSTER_SIZES:
+            trainer = {"id": str(uuid.uuid4()), "role": "trainer"}
+            athlete_ids = await seed_roster(trainer["id"], n_athletes)
+
+            # Primera llamada: athlete_stats todavía no existe y se calcula en bloque
+            start = time.perf_counter()
+            result = await server.trainer_dashboard(sort="fatigue", order="desc", injured=None, has_session_today=None, min_fatigue=None, date=None, user=trainer)
+            cold = (time.perf_counter() - start) * 1000
+            assert result["count"] == n_athletes, result["count"]
+
+            p50, p95 = await timed(lambda: server.trainer_dashboard(sort="fatigue", order="desc", injured=None, has_session_today=None, min_fatigue=None, date=None, user=trainer))
+            n1_p50, _ = await timed(lambda: asyncio.gather(*(server.analytics_summary(athlete_id=a, user=trainer) for a in athlete_ids)), iterations=5)
+            print(f"{n_athletes:<10}{cold:>15.1f}{p50:>12.1f}{p95:>12.1f}{n1_p50:>12.1f}")
+    finally:
+        await server.client.drop_database(os.environ["DB_NAME"])
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,18 +1,21 @@
 import requests
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Header, Request, BackgroundTasks
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Header, Request, BackgroundTasks, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ASCENDING, DESCENDING, InsertOne, UpdateMany, UpdateOne, ReplaceOne, DeleteOne, ReturnDocument
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError
 import os
+import sys
 import logging
 import bcrypt
 import jwt
 import uuid
 from pathlib import Path
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timezone, timedelta
 import shutil
@@ -20,8 +23,18 @@ import asyncio
 import time
 import json
 import re
+import base64
+import hashlib
+import heapq
+import math
+import unicodedata
+import random
+import socket
+from collections import OrderedDict, Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
 from google.api_core.exceptions import ResourceExhausted
+from google.auth import jwt as google_jwt
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -46,12 +59,32 @@ if GEMINI_API_KEY:
 else:
     logger.warning("No se ha encontrado GEMINI_API_KEY en el entorno. El chat de IA no funcionará.")
 
-# Variable global para el Cortocircuito del modelo Pro
-COOLDOWN_PRO_UNTIL = 0
+# Vida de las respuestas cacheadas de generate-workout (Mongo con índice TTL + LRU local)
+BRAIN_CACHE_TTL_SECONDS = int(os.environ.get('BRAIN_CACHE_TTL_SECONDS', 900))
+BRAIN_JOB_WORKERS = int(os.environ.get('BRAIN_JOB_WORKERS', 2))          # generaciones simultáneas por proceso
+BRAIN_JOB_LEASE_SECONDS = int(os.environ.get('BRAIN_JOB_LEASE_SECONDS', 180))
+BRAIN_JOB_MAX_ATTEMPTS = int(os.environ.get('BRAIN_JOB_MAX_ATTEMPTS', 3))
+BRAIN_JOB_POLL_SECONDS = float(os.environ.get('BRAIN_JOB_POLL_SECONDS', 1.0))
+BRAIN_JOB_TTL_SECONDS = int(os.environ.get('BRAIN_JOB_TTL_SECONDS', 86400))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get('CHAT_HISTORY_TOKEN_BUDGET', 3000))  # resumen + turnos enviados al modelo
+CHAT_KEEP_RECENT_TURNS = int(os.environ.get('CHAT_KEEP_RECENT_TURNS', 6))           # turnos que no se resumen nunca
+CHAT_MAX_MESSAGE_CHARS = int(os.environ.get('CHAT_MAX_MESSAGE_CHARS', 4000))
+CHAT_CONVERSATION_TTL_DAYS = int(os.environ.get('CHAT_CONVERSATION_TTL_DAYS', 30))
+CHAT_CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get('CHAT_CONTEXT_CACHE_TTL_SECONDS', 3600))
+# Gemini rechaza cachés de contexto por debajo de un mínimo de tokens; por debajo ni lo intentamos
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('GEMINI_CONTEXT_CACHE_MIN_TOKENS', 4096))
+BRAIN_MEMORY_RETENTION_DAYS = int(os.environ.get('BRAIN_MEMORY_RETENTION_DAYS', 365))  # 0 = sin límite
+BRAIN_FEW_SHOT_K = int(os.environ.get('BRAIN_FEW_SHOT_K', 3))  # 0 = sin ejemplos en el prompt
+BRAIN_FEW_SHOT_MIN_SCORE = float(os.environ.get('BRAIN_FEW_SHOT_MIN_SCORE', 0.1))
 
 JWT_SECRET = os.environ.get('JWT_SECRET')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 876000
+# 'legacy': token de larga duración y usuario leído de BD en cada petición.
+# 'stateless': access token corto con los claims que usan las rutas + refresh token rotatorio.
+AUTH_MODE = os.environ.get('AUTH_MODE', 'legacy')
+ACCESS_TOKEN_MINUTES = int(os.environ.get('ACCESS_TOKEN_MINUTES', 15))
+REFRESH_TOKEN_DAYS = int(os.environ.get('REFRESH_TOKEN_DAYS', 30))
 if not JWT_SECRET:
     logger.error("¡ERROR CRÍTICO: No se ha encontrado JWT_SECRET!")
 
@@ -88,6 +121,184 @@ async def cleanup_old_videos():
 async def start_cleanup_task():
     asyncio.create_task(cleanup_old_videos())
 
+# --- ÍNDICES DE MONGODB ---
+# Registro único de índices: cada entrada cubre el filtro + orden de una consulta caliente.
+# Los id_unique de colecciones con documentos antiguos sin "id" son parciales: varios de esos documentos
+# no deben impedir el índice (un {"id": x} implica $exists y sigue usándolo).
+HAS_ID = {"id": {"$exists": True}}
+INDEX_REGISTRY = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        IndexModel([("trainer_id", ASCENDING), ("role", ASCENDING)], name="trainer_role"),
+    ],
+    "workouts": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True, partialFilterExpression=HAS_ID),
+        IndexModel([("athlete_id", ASCENDING), ("date", DESCENDING), ("id", DESCENDING)], name="athlete_date_id"),
+        IndexModel([("athlete_id", ASCENDING), ("completed", ASCENDING), ("date", DESCENDING)], name="athlete_completed_date"),
+        IndexModel([("microciclo_id", ASCENDING)], name="microciclo"),
+        IndexModel([("trainer_id", ASCENDING), ("date", DESCENDING), ("id", DESCENDING)], name="trainer_date_id"),
+    ],
+    "wellness": [
+        IndexModel([("athlete_id", ASCENDING), ("date", DESCENDING)], name="athlete_date_unique", unique=True),
+    ],
+    "tests": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True, partialFilterExpression=HAS_ID),
+        IndexModel([("athlete_id", ASCENDING), ("date", DESCENDING), ("id", DESCENDING)], name="athlete_date_id"),
+        IndexModel([("trainer_id", ASCENDING), ("date", DESCENDING), ("id", DESCENDING)], name="trainer_date_id"),
+    ],
+    "macrociclos": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True, partialFilterExpression=HAS_ID),
+        IndexModel([("athlete_id", ASCENDING)], name="athlete"),
+    ],
+    "microciclos": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True, partialFilterExpression=HAS_ID),
+        IndexModel([("macrociclo_id", ASCENDING), ("fecha_inicio", ASCENDING), ("fecha_fin", ASCENDING)], name="macrociclo_fechas"),
+    ],
+    "pills": [
+        IndexModel([("trainer_id", ASCENDING), ("created_at", DESCENDING)], name="trainer_created"),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True, partialFilterExpression=HAS_ID),
+    ],
+    "brain_memory": [
+        IndexModel([("learned_at", DESCENDING)], name="learned_at"),
+        IndexModel([("trainer_id", ASCENDING), ("learned_at", DESCENDING)], name="trainer_learned"),
+        # Parcial: los documentos antiguos sin hash no bloquean el índice hasta que se compacten
+        IndexModel([("trainer_id", ASCENDING), ("content_hash", ASCENDING)], name="trainer_hash_unique", unique=True,
+                   partialFilterExpression={"content_hash": {"$exists": True}}),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True, partialFilterExpression=HAS_ID),
+    ],
+    "brain_response_cache": [
+        IndexModel([("created_at", ASCENDING)], name="created_ttl", expireAfterSeconds=BRAIN_CACHE_TTL_SECONDS),
+    ],
+    "brain_jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Un solo trabajo activo por hash de petición: los reintentos del cliente se enganchan al existente
+        IndexModel([("request_hash", ASCENDING)], name="active_hash_unique", unique=True, partialFilterExpression={"active": True}),
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created"),
+        IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)], name="status_lease"),
+        IndexModel([("finished_at", ASCENDING)], name="finished_ttl", expireAfterSeconds=BRAIN_JOB_TTL_SECONDS),
+    ],
+    "brain_analytics_memo": [
+        IndexModel([("created_at", ASCENDING)], name="created_ttl", expireAfterSeconds=2 * 86400),
+    ],
+    "brain_conversations": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("owner_id", ASCENDING), ("updated_at", DESCENDING)], name="owner_updated"),
+        IndexModel([("last_active_at", ASCENDING)], name="last_active_ttl", expireAfterSeconds=CHAT_CONVERSATION_TTL_DAYS * 86400),
+    ],
+    "revoked_tokens": [
+        IndexModel([("jti", ASCENDING)], name="jti_unique", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# Formas de consulta que usa la API: (colección, filtro, orden). Los valores son de ejemplo,
+# al planificador solo le importan los campos.
+QUERY_SHAPES = [
+    ("users", {"id": "x"}, None),
+    ("users", {"email": "x"}, None),
+    ("users", {"trainer_id": "x", "role": "athlete"}, None),
+    ("workouts", {"id": "x"}, None),
+    ("workouts", {"athlete_id": "x"}, [("date", -1)]),
+    ("workouts", {"athlete_id": "x", "date": "2000-01-01"}, None),
+    ("workouts", {"athlete_id": "x", "completed": True}, [("date", -1)]),
+    ("workouts", {"microciclo_id": "x"}, None),
+    ("workouts", {"trainer_id": "x"}, [("date", -1), ("id", -1)]),
+    ("workouts", {"athlete_id": "x", "date": {"$gte": "2000-01-01", "$lte": "2000-01-14"}}, [("date", -1), ("id", -1)]),
+    ("wellness", {"athlete_id": "x"}, [("date", -1)]),
+    ("wellness", {"athlete_id": "x", "date": "2000-01-01"}, None),
+    ("wellness", {"athlete_id": "x", "date": {"$gte": "2000-01-01"}}, None),
+    ("workouts", {"athlete_id": {"$in": ["x", "y"]}, "date": "2000-01-01"}, None),
+    ("tests", {"id": "x"}, None),
+    ("tests", {"athlete_id": "x"}, [("date", -1)]),
+    ("tests", {"athlete_id": "x", "date": {"$gte": "2000-01-01"}}, [("date", -1), ("id", -1)]),
+    ("tests", {"trainer_id": "x"}, [("date", -1), ("id", -1)]),
+    ("macrociclos", {"id": "x"}, None),
+    ("macrociclos", {"athlete_id": "x"}, None),
+    ("microciclos", {"id": "x"}, None),
+    ("microciclos", {"macrociclo_id": "x"}, None),
+    ("microciclos", {"macrociclo_id": {"$in": ["x"]}, "fecha_inicio": {"$lte": "2000-01-01"}, "fecha_fin": {"$gte": "2000-01-01"}}, None),
+    ("pills", {"trainer_id": "x"}, [("created_at", -1)]),
+    ("pills", {"id": "x", "trainer_id": "x"}, None),
+    ("brain_memory", {"trainer_id": "x"}, [("learned_at", -1)]),
+    ("brain_memory", {"trainer_id": "x", "content_hash": "x"}, None),
+    ("brain_memory", {"id": "x", "trainer_id": "x"}, None),
+    ("brain_memory", {"learned_at": {"$lt": "2000-01-01"}}, None),
+    ("brain_conversations", {"id": "x"}, None),
+    ("brain_conversations", {"id": "x", "owner_id": "x"}, None),
+    ("brain_jobs", {"id": "x"}, None),
+    ("brain_jobs", {"request_hash": "x", "active": True}, None),
+    ("brain_jobs", {"status": "queued"}, [("created_at", 1)]),
+    ("brain_jobs", {"status": "running", "lease_until": {"$lt": "2000-01-01"}}, None),
+]
+
+# Índices sustituidos por otros del registro: se eliminan al arrancar si siguen existiendo
+RETIRED_INDEXES = {
+    "microciclos": ["macrociclo", "fechas"],
+    "brain_memory": ["content_hash_unique"],  # el hash ahora es único por entrenador
+}
+
+async def ensure_indexes():
+    """Crea los índices del registro. Un índice que falle (p.ej. por duplicados previos) no bloquea el resto."""
+    for collection_name, names in RETIRED_INDEXES.items():
+        existing = await db[collection_name].index_information()
+        for name in names:
+            if name in existing:
+                try:
+                    await db[collection_name].drop_index(name)
+                    logger.info(f"Índice retirado '{name}' eliminado de '{collection_name}'.")
+                except OperationFailure as e:
+                    if e.code != 27:  # IndexNotFound: otro worker que arrancaba a la vez ya lo eliminó
+                        raise
+    for collection_name, indexes in INDEX_REGISTRY.items():
+        for index in indexes:
+            try:
+                await db[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                if e.code in (85, 86):  # IndexOptionsConflict / IndexKeySpecsConflict: cambió la definición
+                    try:
+                        await db[collection_name].drop_index(index.document['name'])
+                        await db[collection_name].create_indexes([index])
+                        logger.info(f"Índice '{index.document['name']}' de '{collection_name}' recreado con la nueva definición.")
+                        continue
+                    except OperationFailure as retry_error:
+                        e = retry_error
+                logger.error(f"No se pudo crear el índice '{index.document['name']}' de '{collection_name}': {str(e)}")
+
+def _plan_stages(plan: dict):
+    """Recorre recursivamente un plan de explain() devolviendo todos sus stages."""
+    if not isinstance(plan, dict):
+        return
+    if 'stage' in plan:
+        yield plan['stage']
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from _plan_stages(child)
+
+async def verify_query_plans() -> List[str]:
+    """Ejecuta explain() sobre cada forma de consulta registrada y devuelve las que caen en COLLSCAN."""
+    failures = []
+    for collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        winning_plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+        if 'COLLSCAN' in set(_plan_stages(winning_plan)):
+            failures.append(f"{collection_name} {query} sort={sort}")
+    return failures
+
+@app.on_event("startup")
+async def setup_indexes():
+    await ensure_indexes()
+    failures = await verify_query_plans()
+    for failure in failures:
+        logger.error(f"Consulta sin índice (COLLSCAN): {failure}")
+    if failures and os.environ.get('STRICT_INDEXES') == '1':
+        raise RuntimeError(f"{len(failures)} consultas sin índice. Revisa INDEX_REGISTRY.")
+
 @app.get("/ping")
 async def ping():
     return {"status": "awake", "message": "El servidor está activo."}
@@ -96,6 +307,7 @@ api_router = APIRouter(prefix="/api")
 
 # --- MODELOS PYDANTIC ---
 class AnalyticsAnalyzeRequest(BaseModel):
+    athlete_id: Optional[str] = None  # si viene, se añade el perfil y la fase actual al prompt
     athlete_name: str
     fatigue_data: list
     soreness_data: list
@@ -120,6 +332,9 @@ class UserRegister(BaseModel):
     name: str
     role: str = "trainer"
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
 class UserLogin(BaseModel):
     email: str
     password: str
@@ -202,6 +417,16 @@ class WorkoutCreate(BaseModel):
     
 class WorkoutBulkCreate(BaseModel):
     workouts: List[WorkoutCreate]
+
+class MicrocycleGenerateRequest(BaseModel):
+    athlete_id: str
+    microciclo_id: Optional[str] = None   # o bien un rango fecha_inicio/fecha_fin
+    fecha_inicio: Optional[str] = None
+    fecha_fin: Optional[str] = None
+    training_days: Optional[List[str]] = None  # fechas concretas dentro del rango; por defecto todas
+    constraints: Optional[str] = ""
+    athleteContext: dict = {}
+    dry_run: Optional[bool] = False
     
 class MacroCreate(BaseModel):
     athlete_id: str
@@ -237,11 +462,76 @@ class TestUpdate(BaseModel):
     unit: Optional[str] = None
     notes: Optional[str] = None
 
+class RecentSession(BaseModel):
+    title: Optional[str] = None
+    rpe: Any = '?'
+    exercises: List[str] = []
+
+class CurrentPhase(BaseModel):
+    nombre: Optional[str] = None
+    tipo: str = 'CARGA'
+
+class AthleteContext(BaseModel):
+    """Lo que la IA necesita saber del atleta, ya recortado para el prompt."""
+    name: str = 'el atleta'
+    gender: Optional[str] = None
+    sport: Optional[str] = None
+    is_injured: bool = False
+    injury_notes: Optional[str] = None
+    equipment: Optional[str] = None
+    trainer_id: Optional[str] = None
+    found: bool = False
+    recent_sessions: List[RecentSession] = []
+    current_phase: Optional[CurrentPhase] = None
+
 class GeminiChatRequest(BaseModel):
     userMessage: str
     athleteContext: dict = {}
     chatHistory: list = []
     athlete_id: Optional[str] = None
+    bypass_cache: Optional[bool] = False   # ni lee ni escribe la caché de respuestas
+    refresh_cache: Optional[bool] = False  # ignora lo cacheado y guarda la respuesta nueva
+    conversation_id: Optional[str] = None  # con conversación el historial vive en el servidor y chatHistory se ignora
+
+class ConversationCreate(BaseModel):
+    athlete_id: Optional[str] = None
+    athleteContext: dict = {}
+
+# Respuestas de la IA: los valores por defecto rellenan los campos que el modelo omita
+def drop_incomplete_exercises(exercises: list) -> list:
+    """Quita los ejercicios sin nombre: un JSON truncado y reparado puede dejar {"sets": ...} al final."""
+    kept = []
+    for ex in exercises or []:
+        if not isinstance(ex, dict) or not ex.get('name'):
+            continue
+        if isinstance(ex.get('hiit_exercises'), list):
+            ex = {**ex, "hiit_exercises": drop_incomplete_exercises(ex['hiit_exercises'])}
+        kept.append(ex)
+    return kept
+
+class WorkoutDraft(BaseModel):
+    title: str = "Sesión generada por IA"
+    notes: str = ""
+    exercises: List[dict] = []
+
+    _clean_exercises = field_validator("exercises")(drop_incomplete_exercises)
+
+class WorkoutAIResponse(BaseModel):
+    coach_analysis: str = ""
+    response_message: str = "He preparado esta sesión para ti:"
+    workoutData: Optional[WorkoutDraft] = None
+
+class AnalyticsAIResponse(BaseModel):
+    workload_analysis: str = "Datos insuficientes para análisis."
+    progress_analysis: str = "Sigue registrando entrenamientos para ver tu evolución."
+    recommendations: List[str] = []
+
+class MicrocycleAIResponse(BaseModel):
+    coach_analysis: str = ""
+    sessions: list = []  # se validan todas juntas en validate_microcycle_sessions
+
+class SummaryAIResponse(BaseModel):
+    summary: str = ""
 
 # --- MODELOS PYDANTIC ---
 
@@ -252,12 +542,41 @@ class PillCreate(BaseModel):
     assigned_athletes: Optional[List[str]] = []
     
 # --- AUTH HELPERS ---
+# bcrypt tarda 100-300 ms por llamada: se ejecuta en un pool propio y acotado para no bloquear el event loop
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get('PASSWORD_QUEUE_LIMIT', 64))
+PASSWORD_EXECUTOR = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+PASSWORD_STATS = {"pending": 0, "max_pending": 0, "completed": 0, "rejected": 0}
+
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+async def run_password_job(func, *args):
+    """Encola trabajo de bcrypt en PASSWORD_EXECUTOR. Con la cola llena responde 503 en vez de acumular latencia."""
+    if PASSWORD_STATS["pending"] >= PASSWORD_QUEUE_LIMIT:
+        PASSWORD_STATS["rejected"] += 1
+        raise HTTPException(status_code=503, detail="Servidor ocupado, inténtalo de nuevo en unos segundos.")
+    PASSWORD_STATS["pending"] += 1
+    PASSWORD_STATS["max_pending"] = max(PASSWORD_STATS["max_pending"], PASSWORD_STATS["pending"])
+    try:
+        return await asyncio.get_running_loop().run_in_executor(PASSWORD_EXECUTOR, func, *args)
+    finally:
+        PASSWORD_STATS["pending"] -= 1
+        PASSWORD_STATS["completed"] += 1
+
+async def hash_password_async(password: str) -> str:
+    return await run_password_job(hash_password, password)
+
+async def verify_password_async(password: str, hashed: str) -> bool:
+    return await run_password_job(verify_password, password, hashed)
+
+def password_stats() -> dict:
+    return {**PASSWORD_STATS, "workers": PASSWORD_HASH_WORKERS, "queue_limit": PASSWORD_QUEUE_LIMIT, "rounds": BCRYPT_ROUNDS}
+
 def create_token(user_id: str, role: str) -> str:
     payload = {
         'user_id': user_id,
@@ -266,15 +585,135 @@ def create_token(user_id: str, role: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+# Claims que viajan en el access token: todo lo que las rutas leen del usuario autenticado.
+ACCESS_TOKEN_CLAIMS = ('trainer_id', 'name', 'email_notifications')
+
+def create_access_token(user: dict) -> str:
+    payload = {
+        'user_id': user['id'],
+        'role': user['role'],
+        'typ': 'access',
+        'exp': datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_MINUTES)
+    }
+    payload.update({claim: user.get(claim) for claim in ACCESS_TOKEN_CLAIMS})
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def create_refresh_token(user: dict) -> str:
+    payload = {
+        'user_id': user['id'],
+        'typ': 'refresh',
+        'jti': uuid.uuid4().hex,
+        'exp': datetime.now(timezone.utc) + timedelta(days=REFRESH_TOKEN_DAYS)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+def build_auth_response(user: dict) -> dict:
+    public_user = {k: v for k, v in user.items() if k not in ('_id', 'password')}
+    if AUTH_MODE == 'stateless':
+        return {
+            "token": create_access_token(user),
+            "refresh_token": create_refresh_token(user),
+            "expires_in": ACCESS_TOKEN_MINUTES * 60,
+            "user": public_user
+        }
+    return {"token": create_token(user['id'], user['role']), "user": public_user}
+
+async def revoke_refresh_token(payload: dict) -> bool:
+    """Añade el jti al conjunto de revocados (se autolimpia con TTL al expirar). False si ya estaba revocado."""
+    try:
+        await db.revoked_tokens.insert_one({
+            "jti": payload['jti'],
+            "user_id": payload['user_id'],
+            "expires_at": datetime.fromtimestamp(payload['exp'], tz=timezone.utc)
+        })
+        return True
+    except DuplicateKeyError:
+        return False
+
 def decode_token(token: str) -> dict:
     try:
         return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
     except Exception:
         raise HTTPException(status_code=401, detail="Token inválido o expirado")
 
+def resolve_trainer_id(user: dict) -> Optional[str]:
+    """Entrenador 'dueño' de los datos del usuario: él mismo si es entrenador, su entrenador si es atleta."""
+    return user['id'] if user['role'] == 'trainer' else user.get('trainer_id')
+
+def scoped_athlete_query(user: dict, athlete_id: Optional[str] = None) -> dict:
+    """Filtro para listados: el atleta solo ve lo suyo; el entrenador, un atleta concreto o todo su equipo."""
+    if user['role'] == 'athlete':
+        return {'athlete_id': user['id']}
+    return {'athlete_id': athlete_id} if athlete_id else {'trainer_id': user['id']}
+
+# --- CACHÉ DE USUARIOS ---
+class TTLCache:
+    """LRU acotada con caducidad por entrada. Es local a cada worker: el TTL limita cuánto puede desfasarse."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data), "maxsize": self.maxsize, "ttl_seconds": self.ttl,
+            "hits": self.hits, "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+USER_CACHE = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_MAX_SIZE', 1024)),
+    ttl=float(os.environ.get('USER_CACHE_TTL_SECONDS', 60))
+)
+
+async def get_cached_user(user_id: str) -> Optional[dict]:
+    """Documento del usuario (sin _id) pasando por la caché. Devuelve una copia para que nadie mute la entrada cacheada."""
+    user = USER_CACHE.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        if not user:
+            return None
+        USER_CACHE.set(user_id, user)
+    return dict(user)
+
+def invalidate_user_cache(user_id: str):
+    USER_CACHE.invalidate(user_id)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     payload = decode_token(credentials.credentials)
-    user = await db.users.find_one({"id": payload['user_id']}, {"_id": 0})
+    token_type = payload.get('typ')
+    if token_type == 'refresh':
+        raise HTTPException(status_code=401, detail="Token inválido o expirado")
+    if token_type == 'access':
+        # Modo stateless: el usuario se reconstruye desde los claims, sin ir a Mongo
+        user = {'id': payload['user_id'], 'role': payload['role']}
+        user.update({claim: payload.get(claim) for claim in ACCESS_TOKEN_CLAIMS})
+        return user
+    user = await get_cached_user(payload['user_id'])
     if not user:
         raise HTTPException(status_code=401, detail="Usuario no encontrado")
     return user
@@ -335,6 +774,39 @@ def send_web_push(subscription_info: dict, title: str, message: str):
         logger.error(f"Fallo enviando web push: {str(e)}")
         return False
 
+# --- PAGINACIÓN POR CURSOR (KEYSET) ---
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(doc: dict) -> str:
+    raw = json.dumps([doc.get('date'), doc.get('id')]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8').rstrip('=')
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_date, cursor_id = json.loads(raw)
+        return cursor_date, cursor_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def apply_date_range(query: dict, date_from: Optional[str], date_to: Optional[str]) -> dict:
+    if date_from or date_to:
+        date_filter = {}
+        if date_from: date_filter['$gte'] = date_from
+        if date_to: date_filter['$lte'] = date_to
+        query['date'] = date_filter
+    return query
+
+async def paginate_by_date(collection, query: dict, projection: dict, limit: int, cursor: Optional[str] = None) -> dict:
+    """Página ordenada por (date, id) descendente. El cursor apunta al último documento devuelto."""
+    if cursor:
+        cursor_date, cursor_id = decode_cursor(cursor)
+        query = {"$and": [query, {"$or": [{"date": {"$lt": cursor_date}}, {"date": cursor_date, "id": {"$lt": cursor_id}}]}]}
+    docs = await collection.find(query, projection).sort([("date", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    has_more = len(docs) > limit
+    items = docs[:limit]
+    return {"items": items, "next_cursor": encode_cursor(items[-1]) if has_more else None}
+
 # --- RUTAS DE PÍLDORAS (PREHAB/ACTIVACIÓN) ---
 @api_router.post("/pills")
 async def create_pill(data: PillCreate, user=Depends(get_current_user)):
@@ -347,7 +819,7 @@ async def create_pill(data: PillCreate, user=Depends(get_current_user)):
 
 @api_router.get("/pills")
 async def get_pills(user=Depends(get_current_user)):
-    target_trainer_id = user['id'] if user['role'] == 'trainer' else user.get('trainer_id')
+    target_trainer_id = resolve_trainer_id(user)
     pills = await db.pills.find({"trainer_id": target_trainer_id}, {"_id": 0}).sort("created_at", -1).to_list(100)
     return pills
 
@@ -368,63 +840,1157 @@ async def delete_pill(pill_id: str, user=Depends(get_current_user)):
     return {"status": "success"}
 
 # --- RUTAS DE MACHINE LEARNING (CEREBRO IA) ---
+# brain_memory guarda una entrada por contenido (título + ejercicios normalizados): repetir una sesión
+# solo incrementa usage_count y actualiza learned_at.
+def _normalize_memory_value(value):
+    if isinstance(value, str):
+        return re.sub(r'\s+', ' ', value).strip().lower()
+    if isinstance(value, dict):
+        return {k: _normalize_memory_value(v) for k, v in value.items() if v not in (None, "", [], {})}
+    if isinstance(value, list):
+        return [_normalize_memory_value(v) for v in value]
+    return value
+
+def brain_memory_hash(title: str, exercises: list) -> str:
+    normalized = [_normalize_memory_value(title or ''), _normalize_memory_value(exercises or [])]
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def brain_memory_upsert(trainer_id: Optional[str], content_hash: str, doc: dict, uses: int = 1, first_learned_at: Optional[str] = None) -> UpdateOne:
+    return UpdateOne(
+        {"trainer_id": trainer_id, "content_hash": content_hash},
+        {
+            "$setOnInsert": {"id": str(uuid.uuid4()), "title": doc.get('title'), "exercises": doc.get('exercises'), "notes": doc.get('notes')},
+            "$max": {"learned_at": doc['learned_at']},
+            "$min": {"first_learned_at": first_learned_at or doc['learned_at']},
+            "$inc": {"usage_count": uses},
+        },
+        upsert=True
+    )
+
+# brain_memory_counters guarda {_id: trainer_id, total}: se ajusta con $inc en cada alta o borrado y
+# `python server.py reconcile-brain-counters` lo recalcula si alguna escritura se quedó a medias.
+async def bump_brain_counter(trainer_id: Optional[str], delta: int):
+    if trainer_id and delta:
+        await db.brain_memory_counters.update_one(
+            {"_id": trainer_id},
+            {"$inc": {"total": delta}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+
+async def learn_workouts(workouts: List[dict], trainer_id: str):
+    """Registra sesiones del entrenador en brain_memory con un solo bulk_write; las repetidas suman uso."""
+    now = datetime.now(timezone.utc).isoformat()
+    grouped = {}
+    for w in workouts:
+        content_hash = brain_memory_hash(w.get('title'), w.get('exercises'))
+        entry = grouped.setdefault(content_hash, {"doc": {**w, "learned_at": now}, "uses": 0})
+        entry["uses"] += 1
+    if not grouped:
+        return
+    ops = [brain_memory_upsert(trainer_id, h, entry["doc"], entry["uses"]) for h, entry in grouped.items()]
+    try:
+        result = await db.brain_memory.bulk_write(ops, ordered=False)
+        created = result.upserted_count
+    except BulkWriteError as e:
+        # Dos upserts simultáneos del mismo contenido: el perdedor choca con el índice único. Reintentar ya actualiza.
+        if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+            raise
+        retry = [ops[err['index']] for err in e.details['writeErrors']]
+        created = e.details.get('nUpserted', 0)
+        created += (await db.brain_memory.bulk_write(retry, ordered=False)).upserted_count
+    await bump_brain_counter(trainer_id, created)
+    for h, entry in grouped.items():
+        BRAIN_MEMORY_INDEX.add(trainer_id, h, entry["doc"])
+
+async def cleanup_brain_memory():
+    # Primera pasada a las 24 h: al arrancar ya reconstruye el índice build_brain_memory_index
+    while True:
+        await asyncio.sleep(86400)
+        try:
+            if BRAIN_MEMORY_RETENTION_DAYS > 0:
+                cutoff = (datetime.now(timezone.utc) - timedelta(days=BRAIN_MEMORY_RETENTION_DAYS)).isoformat()
+                # Borrado por entrenador para descontar exactamente lo eliminado de cada contador
+                trainer_ids = await db.brain_memory.distinct("trainer_id", {"learned_at": {"$lt": cutoff}})
+                deleted = 0
+                for trainer_id in trainer_ids:
+                    result = await db.brain_memory.delete_many({"trainer_id": trainer_id, "learned_at": {"$lt": cutoff}})
+                    await bump_brain_counter(trainer_id, -result.deleted_count)
+                    deleted += result.deleted_count
+                if deleted:
+                    logger.info(f"Memoria IA: {deleted} entradas sin uso en {BRAIN_MEMORY_RETENTION_DAYS} días eliminadas.")
+            # Reconstruir también recoge lo aprendido por otros workers y descarta lo caducado
+            await BRAIN_MEMORY_INDEX.rebuild()
+        except Exception as e:
+            logger.error(f"Error en la limpieza de memoria IA: {str(e)}")
+
+@app.on_event("startup")
+async def start_brain_memory_cleanup():
+    asyncio.create_task(cleanup_brain_memory())
+
 @api_router.get("/brain/memory")
 async def get_brain_memory(user=Depends(get_current_user)):
     if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
-    count = await db.brain_memory.count_documents({})
-    return {"status": "success", "total_learned": count}
+    counter = await db.brain_memory_counters.find_one({"_id": user['id']})
+    return {"status": "success", "total_learned": max(0, counter['total']) if counter else 0}
 
 @api_router.get("/brain/memory/examples")
 async def get_brain_examples(user=Depends(get_current_user)):
     if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
-    examples = await db.brain_memory.find({}, {"_id": 0, "learned_at": 0, "id": 0}).sort("learned_at", -1).limit(5).to_list(5)
+    examples = await db.brain_memory.find(
+        {"trainer_id": user['id']},
+        {"_id": 0, "learned_at": 0, "trainer_id": 0, "content_hash": 0, "first_learned_at": 0}
+    ).sort("learned_at", -1).limit(5).to_list(5)
     return {"status": "success", "examples": examples}
 
-@api_router.post("/brain/generate-workout")
-async def generate_workout_api(data: GeminiChatRequest, user=Depends(get_current_user)):
-    global COOLDOWN_PRO_UNTIL
+@api_router.delete("/brain/memory/{memory_id}")
+async def delete_brain_memory(memory_id: str, user=Depends(get_current_user)):
+    if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
+    doc = await db.brain_memory.find_one_and_delete({"id": memory_id, "trainer_id": user['id']}, {"_id": 0, "content_hash": 1})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Sesión no encontrada en la memoria")
+    await bump_brain_counter(user['id'], -1)
+    BRAIN_MEMORY_INDEX.remove(user['id'], doc.get('content_hash'))
+    return {"status": "success"}
 
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="API de Gemini no configurada.")
-        
+# --- PROVEEDORES DE IA ---
+MODEL_PRO_ID = "models/gemini-3.1-pro-preview"
+MODEL_FLASH_ID = "models/gemini-2.5-flash"
+
+class QuotaExceededError(Exception):
+    """Cuota agotada (429) en el proveedor. El mensaje puede incluir 'retry_delay { seconds: N }'."""
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Aproximación barata (~4 caracteres por token) para presupuestos de contexto."""
+    return len(text or '') // 4 + 1
+
+class LLMProvider:
+    """Interfaz común de los proveedores del cerebro IA. generate() devuelve el texto crudo del modelo."""
+    name = "base"
+
+    def is_configured(self) -> bool:
+        return True
+
+    async def generate(self, model_id: str, prompt: str, system_instruction: Optional[str] = None,
+                       history: Optional[List[dict]] = None, cached_content: Optional[str] = None,
+                       response_schema: Optional[dict] = None) -> str:
+        """
+        history: turnos previos [{"role": "user"|"model", "parts": [texto]}]. cached_content: ver cache_context().
+        response_schema: esquema OpenAPI de la respuesta JSON, si el proveedor admite salida estructurada.
+        """
+        raise NotImplementedError
+
+    async def cache_context(self, model_id: str, system_instruction: str, ttl_seconds: int) -> Optional[str]:
+        """Sube un system instruction estático a la caché de contexto del proveedor. None si no lo soporta."""
+        return None
+
+    async def drop_context(self, name: str):
+        pass
+
+    async def stream(self, model_id: str, prompt: str, system_instruction: Optional[str] = None,
+                     response_schema: Optional[dict] = None):
+        """Trozos de texto según llegan. Por defecto, la respuesta completa en un único trozo."""
+        yield await self.generate(model_id, prompt, system_instruction, response_schema=response_schema)
+
+    def stats(self) -> dict:
+        return {"provider": self.name}
+
+class GeminiProvider(LLMProvider):
+    """
+    Capa asíncrona sobre google.generativeai. Usa generate_content_async (o un hilo si el SDK no lo
+    trae) para no congelar el worker durante los 10-30 s que tarda el modelo, y reutiliza los
+    GenerativeModel ya construidos para cada (modelo, system instruction).
+    """
+
+    name = "gemini"
+
+    def __init__(self):
+        self._models = TTLCache(maxsize=64, ttl=3600)
+
+    def is_configured(self) -> bool:
+        return bool(GEMINI_API_KEY)
+
+    @staticmethod
+    def _generation_config(response_schema: Optional[dict]) -> dict:
+        config = {"response_mime_type": "application/json"}
+        if response_schema:
+            config["response_schema"] = response_schema
+        return config
+
+    def _get_model(self, model_id: str, system_instruction: Optional[str], response_schema: Optional[dict] = None):
+        # Los esquemas son constantes del módulo (RESPONSE_SCHEMAS): su id identifica la variante
+        key = (model_id, system_instruction, id(response_schema) if response_schema else None)
+        model = self._models.get(key)
+        if model is None:
+            model = genai.GenerativeModel(
+                model_name=model_id,
+                system_instruction=system_instruction,
+                generation_config=self._generation_config(response_schema)
+            )
+            self._models.set(key, model)
+        return model
+
+    async def _get_cached_model(self, cached_content: str, response_schema: Optional[dict] = None):
+        key = ("cached", cached_content, id(response_schema) if response_schema else None)
+        model = self._models.get(key)
+        if model is None:
+            model = await asyncio.to_thread(
+                genai.GenerativeModel.from_cached_content,
+                cached_content=cached_content,
+                generation_config=self._generation_config(response_schema)
+            )
+            self._models.set(key, model)
+        return model
+
+    async def generate(self, model_id: str, prompt: str, system_instruction: Optional[str] = None,
+                       history: Optional[List[dict]] = None, cached_content: Optional[str] = None,
+                       response_schema: Optional[dict] = None) -> str:
+        if cached_content:
+            model = await self._get_cached_model(cached_content, response_schema)
+        else:
+            model = self._get_model(model_id, system_instruction, response_schema)
+        contents = [*history, {"role": "user", "parts": [prompt]}] if history else prompt
+        if hasattr(model, 'generate_content_async'):
+            response = await model.generate_content_async(contents)
+        else:
+            response = await asyncio.to_thread(model.generate_content, contents)
+        return response.text
+
+    async def cache_context(self, model_id: str, system_instruction: str, ttl_seconds: int) -> Optional[str]:
+        if estimate_tokens(system_instruction) < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        try:
+            cached = await asyncio.to_thread(
+                genai.caching.CachedContent.create,
+                model=model_id, system_instruction=system_instruction, ttl=timedelta(seconds=ttl_seconds)
+            )
+            return cached.name
+        except Exception as e:
+            logger.warning(f"No se pudo crear la caché de contexto en {model_id}: {str(e)}")
+            return None
+
+    async def drop_context(self, name: str):
+        try:
+            await asyncio.to_thread(lambda: genai.caching.CachedContent.get(name).delete())
+        except Exception as e:
+            logger.warning(f"No se pudo borrar la caché de contexto {name}: {str(e)}")
+
+    async def stream(self, model_id: str, prompt: str, system_instruction: Optional[str] = None,
+                     response_schema: Optional[dict] = None):
+        model = self._get_model(model_id, system_instruction, response_schema)
+        if not hasattr(model, 'generate_content_async'):
+            yield await self.generate(model_id, prompt, system_instruction, response_schema=response_schema)
+            return
+        response = await model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Trozo sin texto (p.ej. solo metadatos de seguridad)
+                continue
+            if text:
+                yield text
+
+class FakeLLMProvider(LLMProvider):
+    """
+    Proveedor local para pruebas de carga y benchmarks: reproduce respuestas JSON grabadas sin red
+    ni cuota. Cada grabación se elige si todas sus claves de primer nivel aparecen en el prompt
+    (p.ej. 'workoutData' o 'workload_analysis'). Latencia, errores y 429 son configurables por modelo.
+    """
+    name = "fake"
+
+    def __init__(self, responses_dir: Path, latency_ms: Dict[str, float], error_rate: float = 0.0,
+                 quota_rates: Optional[Dict[str, float]] = None, retry_delay: int = 30, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.quota_rates = quota_rates or {}
+        self.retry_delay = retry_delay
+        self._rng = random.Random(seed)
+        self._recordings = []
+        for path in sorted(Path(responses_dir).glob("*.json")):
+            text = path.read_text(encoding='utf-8')
+            self._recordings.append((list(json.loads(text).keys()), text))
+        if not self._recordings:
+            raise RuntimeError(f"No hay respuestas grabadas en {responses_dir}")
+        self._stats = {}
+
+    def _count(self, model_id: str, outcome: str):
+        model_stats = self._stats.setdefault(model_id, {"calls": 0, "ok": 0, "quota_errors": 0, "errors": 0})
+        model_stats[outcome] += 1
+
+    def _latency(self, model_id: str) -> float:
+        latency = self.latency_ms.get(model_id, self.latency_ms.get("default", 0))
+        return max(0.0, self._rng.gauss(latency, latency * 0.1)) / 1000
+
+    async def generate(self, model_id: str, prompt: str, system_instruction: Optional[str] = None,
+                       history: Optional[List[dict]] = None, cached_content: Optional[str] = None,
+                       response_schema: Optional[dict] = None) -> str:
+        return await self._respond(model_id, prompt, system_instruction, self._latency(model_id))
+
+    async def stream(self, model_id: str, prompt: str, system_instruction: Optional[str] = None,
+                     response_schema: Optional[dict] = None):
+        # El primer trozo llega tras ~20% de la latencia total; el resto se reparte entre los trozos
+        latency = self._latency(model_id)
+        text = await self._respond(model_id, prompt, system_instruction, latency * 0.2)
+        pieces = [text[i:i + 64] for i in range(0, len(text), 64)]
+        for piece in pieces:
+            yield piece
+            await asyncio.sleep(latency * 0.8 / len(pieces))
+
+    async def _respond(self, model_id: str, prompt: str, system_instruction: Optional[str], delay: float) -> str:
+        self._count(model_id, "calls")
+        await asyncio.sleep(delay)
+
+        if self._rng.random() < self.quota_rates.get(model_id, self.quota_rates.get("default", 0.0)):
+            self._count(model_id, "quota_errors")
+            raise QuotaExceededError(f"429 Quota exceeded (simulado) retry_delay {{ seconds: {self.retry_delay} }}")
+        if self._rng.random() < self.error_rate:
+            self._count(model_id, "errors")
+            raise RuntimeError("Fallo simulado del proveedor de IA")
+
+        full_prompt = f"{system_instruction or ''}\n{prompt}"
+        candidates = [text for keys, text in self._recordings if all(k in full_prompt for k in keys)]
+        self._count(model_id, "ok")
+        return self._rng.choice(candidates or [self._recordings[0][1]])
+
+    def stats(self) -> dict:
+        return {"provider": self.name, "models": self._stats}
+
+def build_llm_provider() -> LLMProvider:
+    if os.environ.get('LLM_PROVIDER', 'gemini') == 'fake':
+        seed = os.environ.get('LLM_FAKE_SEED')
+        return FakeLLMProvider(
+            responses_dir=Path(os.environ.get('LLM_FAKE_RESPONSES_DIR', ROOT_DIR / "fixtures" / "llm")),
+            latency_ms={
+                MODEL_PRO_ID: float(os.environ.get('LLM_FAKE_PRO_LATENCY_MS', 1500)),
+                MODEL_FLASH_ID: float(os.environ.get('LLM_FAKE_FLASH_LATENCY_MS', 500)),
+            },
+            error_rate=float(os.environ.get('LLM_FAKE_ERROR_RATE', 0)),
+            quota_rates={
+                MODEL_PRO_ID: float(os.environ.get('LLM_FAKE_PRO_QUOTA_RATE', 0)),
+                MODEL_FLASH_ID: float(os.environ.get('LLM_FAKE_FLASH_QUOTA_RATE', 0)),
+            },
+            retry_delay=int(os.environ.get('LLM_FAKE_RETRY_DELAY', 30)),
+            seed=int(seed) if seed else None
+        )
+    return GeminiProvider()
+
+LLM_PROVIDER = build_llm_provider()
+
+# --- CORTOCIRCUITO COMPARTIDO DEL MODELO PRO ---
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+class MemoryBreakerStore:
+    """Almacén local (un solo proceso) con la misma interfaz que MongoBreakerStore. Útil en desarrollo y tests."""
+
+    def __init__(self):
+        self._docs = {}
+
+    async def get(self, name: str) -> Optional[dict]:
+        doc = self._docs.get(name)
+        return dict(doc) if doc else None
+
+    async def set(self, name: str, updates: dict):
+        doc = self._docs.setdefault(name, {"_id": name, "version": 0})
+        doc.update(updates)
+        doc["version"] += 1
+
+    async def compare_and_set(self, name: str, version: int, updates: dict) -> bool:
+        doc = self._docs.get(name)
+        if not doc or doc["version"] != version:
+            return False
+        await self.set(name, updates)
+        return True
+
+class MongoBreakerStore:
+    """Estado del cortocircuito en un documento de Mongo compartido por todos los workers y réplicas."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def get(self, name: str) -> Optional[dict]:
+        return await self.collection.find_one({"_id": name})
+
+    async def set(self, name: str, updates: dict):
+        try:
+            await self.collection.update_one({"_id": name}, {"$set": updates, "$inc": {"version": 1}}, upsert=True)
+        except DuplicateKeyError:
+            # Dos workers crearon el documento a la vez: ya existe, basta con actualizarlo
+            await self.collection.update_one({"_id": name}, {"$set": updates, "$inc": {"version": 1}})
+
+    async def compare_and_set(self, name: str, version: int, updates: dict) -> bool:
+        result = await self.collection.update_one({"_id": name, "version": version}, {"$set": updates, "$inc": {"version": 1}})
+        return result.modified_count == 1
+
+class CircuitBreaker:
+    """
+    Cortocircuito closed → open → half_open. El primer 429 lo abre para todos los workers; al acabar
+    el cooldown, un único worker gana (compare-and-set sobre 'version') la petición de prueba.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, store, probe_timeout: int = 120):
+        self.name = name
+        self.store = store
+        self.probe_timeout = probe_timeout
+        self._last_seen = None
+
+    async def _read(self) -> dict:
+        doc = await self.store.get(self.name) or {"state": self.CLOSED, "version": 0}
+        self._last_seen = doc
+        return doc
+
+    async def allow_request(self) -> bool:
+        doc = await self._read()
+        now = time.time()
+        if doc["state"] == self.CLOSED:
+            return True
+        if doc["state"] == self.OPEN and now < doc.get("open_until", 0):
+            return False
+        if doc["state"] == self.HALF_OPEN and now < doc.get("probe_until", 0):
+            return False
+        # Cooldown agotado (o la sonda anterior no respondió): solo un worker prueba
+        return await self.store.compare_and_set(self.name, doc["version"], {
+            "state": self.HALF_OPEN, "probe_until": now + self.probe_timeout, "probe_owner": WORKER_ID
+        })
+
+    async def record_success(self):
+        if self._last_seen and self._last_seen["state"] == self.CLOSED:
+            return
+        await self.store.set(self.name, {"state": self.CLOSED, "closed_at": time.time()})
+        self._last_seen = None
+
+    async def record_failure(self, cooldown_seconds: int):
+        now = time.time()
+        await self.store.set(self.name, {"state": self.OPEN, "open_until": now + cooldown_seconds, "opened_at": now, "opened_by": WORKER_ID})
+        self._last_seen = None
+
+    def remaining_cooldown(self) -> int:
+        if not self._last_seen:
+            return 0
+        return max(0, int(self._last_seen.get("open_until", 0) - time.time()))
+
+    async def status(self) -> dict:
+        doc = await self._read()
+        return {k: v for k, v in doc.items() if k != "_id"}
+
+def build_breaker_store():
+    if os.environ.get('BRAIN_BREAKER_STORE', 'mongo') == 'memory':
+        return MemoryBreakerStore()
+    return MongoBreakerStore(db.circuit_breakers)
+
+PRO_BREAKER = CircuitBreaker("gemini-pro", build_breaker_store(), probe_timeout=int(os.environ.get('BRAIN_BREAKER_PROBE_TIMEOUT', 120)))
+
+def is_quota_error(e: Exception) -> bool:
+    error_str = str(e)
+    return "429" in error_str or "Quota" in error_str or isinstance(e, (ResourceExhausted, QuotaExceededError))
+
+def parse_retry_delay(error_str: str, default: int = 60) -> int:
+    match = re.search(r'retry_delay\s*\{\s*seconds:\s*(\d+)\s*\}', error_str)
+    return int(match.group(1)) + 5 if match else default
+
+async def stream_with_fallback(prompt: str, system_instruction: Optional[str] = None, response_schema: Optional[dict] = None):
+    """
+    Versión en streaming de generate_with_fallback. Emite ('model', id) y luego ('token', texto).
+    El rescate con Flash solo es posible si Pro falla antes del primer trozo.
+    """
+    intentar_pro = await PRO_BREAKER.allow_request()
+    if not intentar_pro:
+        logger.info(f"Usando modelo Flash (Pro en cooldown por {PRO_BREAKER.remaining_cooldown()}s más).")
+
+    for model_id in ([MODEL_PRO_ID, MODEL_FLASH_ID] if intentar_pro else [MODEL_FLASH_ID]):
+        started = False
+        try:
+            async for text in LLM_PROVIDER.stream(model_id, prompt, system_instruction, response_schema=response_schema):
+                if not started:
+                    started = True
+                    yield ("model", model_id)
+                yield ("token", text)
+            if model_id == MODEL_PRO_ID:
+                await PRO_BREAKER.record_success()
+            return
+        except Exception as e:
+            error_str = str(e)
+            if started:
+                logger.error(f"Streaming de IA interrumpido: {error_str}")
+                raise HTTPException(status_code=500, detail=f"Error conectando con la IA: {error_str}")
+            if not is_quota_error(e):
+                logger.error(f"Error IA desconocido: {error_str}")
+                raise HTTPException(status_code=500, detail=f"Error conectando con la IA: {error_str}")
+            if model_id == MODEL_FLASH_ID:
+                logger.error("Cuota excedida incluso en el modelo Flash.")
+                raise HTTPException(status_code=429, detail="Límite de peticiones alcanzado. Por favor, espera un poco.")
+            cooldown_seconds = parse_retry_delay(error_str)
+            logger.warning(f"Cuota de Gemini Pro excedida. Aplicando cooldown de {cooldown_seconds}s. Cambiando a Flash...")
+            await PRO_BREAKER.record_failure(cooldown_seconds)
+
+class LatencySamples:
+    """Últimas N duraciones de una fase, para p50/p95 en /system/stats."""
+
+    def __init__(self, size: int = 500):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds * 1000)
+        self.count += 1
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {"count": 0}
+        ordered = sorted(self.samples)
+        return {
+            "count": self.count,
+            "p50_ms": round(ordered[len(ordered) // 2], 1),
+            "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+        }
+
+# --- ENRUTADO DE MODELOS ---
+# Cada worker mide latencia y errores de cada modelo y elige por clase de petición:
+#  - "interactive" (chat del entrenador): Pro salvo que vaya lento o falle; opcionalmente con cobertura
+#    (hedging): si Pro no ha contestado en ROUTER_HEDGE_AFTER_MS se lanza Flash y gana el primero.
+#  - "batch" (analíticas, microciclos, trabajos en cola): Pro salvo que falle; la latencia da igual.
+ROUTER_WINDOW = int(os.environ.get('ROUTER_WINDOW', 200))
+ROUTER_MIN_SAMPLES = int(os.environ.get('ROUTER_MIN_SAMPLES', 20))
+ROUTER_MAX_ERROR_RATE = float(os.environ.get('ROUTER_MAX_ERROR_RATE', 0.5))
+ROUTER_INTERACTIVE_P95_MS = float(os.environ.get('ROUTER_INTERACTIVE_P95_MS', 30000))
+ROUTER_HEDGE_ENABLED = os.environ.get('ROUTER_HEDGE_ENABLED', '0') == '1'
+ROUTER_HEDGE_AFTER_MS = os.environ.get('ROUTER_HEDGE_AFTER_MS', '8000')  # milisegundos o 'auto' (p50 de Pro)
+# Las decisiones solo miran muestras recientes, y mientras Pro está apartado 1 de cada N peticiones lo sondea:
+# sin esto, un Pro descartado nunca volvería a generar muestras con las que rehabilitarse.
+ROUTER_SAMPLE_TTL_SECONDS = float(os.environ.get('ROUTER_SAMPLE_TTL_SECONDS', 600))
+ROUTER_PROBE_EVERY = int(os.environ.get('ROUTER_PROBE_EVERY', 20))  # 0 = sin sondeo
+
+class ModelRouter:
+    def __init__(self, model_ids: List[str]):
+        self.latency = {model_id: LatencySamples(ROUTER_WINDOW) for model_id in model_ids}
+        self.outcomes = {model_id: deque(maxlen=ROUTER_WINDOW) for model_id in model_ids}  # (instante, ok)
+        self.timings = {model_id: deque(maxlen=ROUTER_WINDOW) for model_id in model_ids}  # (instante, ms)
+        self.pro_avoided = 0
+        self.counters = {model_id: {"calls": 0, "errors": 0, "quota_errors": 0, "cancelled": 0} for model_id in model_ids}
+        self.decisions = {}
+        self.recent = deque(maxlen=50)
+
+    def record(self, model_id: str, seconds: float, ok: bool, quota: bool = False):
+        counters = self.counters[model_id]
+        counters["calls"] += 1
+        now = time.monotonic()
+        if ok:
+            self.latency[model_id].add(seconds)
+            self.timings[model_id].append((now, seconds * 1000))
+        else:
+            counters["quota_errors" if quota else "errors"] += 1
+        # Los 429 los gestiona el cortocircuito: aquí solo cuentan los fallos "de verdad"
+        if not quota:
+            self.outcomes[model_id].append((now, ok))
+
+    def record_cancel(self, model_id: str):
+        self.counters[model_id]["cancelled"] += 1
+
+    @staticmethod
+    def _recent(window: deque) -> deque:
+        cutoff = time.monotonic() - ROUTER_SAMPLE_TTL_SECONDS
+        while window and window[0][0] < cutoff:
+            window.popleft()
+        return window
+
+    def error_rate(self, model_id: str) -> float:
+        outcomes = self._recent(self.outcomes[model_id])
+        return (sum(1 for _, ok in outcomes if not ok) / len(outcomes)) if outcomes else 0.0
+
+    def _p95_ms(self, model_id: str) -> Optional[float]:
+        timings = self._recent(self.timings[model_id])
+        if len(timings) < ROUTER_MIN_SAMPLES:
+            return None
+        ordered = sorted(ms for _, ms in timings)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def hedge_after(self) -> float:
+        if ROUTER_HEDGE_AFTER_MS == 'auto':
+            summary = self.latency[MODEL_PRO_ID].summary()
+            return max(1.0, summary["p50_ms"] / 1000) if summary["count"] >= ROUTER_MIN_SAMPLES else 8.0
+        return float(ROUTER_HEDGE_AFTER_MS) / 1000
+
+    async def choose(self, request_class: str) -> dict:
+        """Devuelve {"model_id", "hedge_after" (s o None), "reason"}."""
+        decision = {"model_id": MODEL_PRO_ID, "hedge_after": None, "reason": "default"}
+        error_rate = self.error_rate(MODEL_PRO_ID)  # poda antes de contar las muestras recientes
+        pro_errors = len(self.outcomes[MODEL_PRO_ID]) >= ROUTER_MIN_SAMPLES and error_rate > ROUTER_MAX_ERROR_RATE
+        pro_p95 = self._p95_ms(MODEL_PRO_ID)
+        avoid = "pro_error_rate" if pro_errors else None
+        if not avoid and request_class == "interactive" and pro_p95 is not None and pro_p95 > ROUTER_INTERACTIVE_P95_MS:
+            avoid = "pro_slow"
+        probe = False
+        if avoid:
+            self.pro_avoided += 1
+            probe = ROUTER_PROBE_EVERY > 0 and self.pro_avoided % ROUTER_PROBE_EVERY == 0
+            if not probe:
+                decision.update(model_id=MODEL_FLASH_ID, reason=avoid)
+        if decision["model_id"] == MODEL_PRO_ID:
+            # El cortocircuito se consulta lo último: en half-open, allow_request() reserva la única sonda
+            if not await PRO_BREAKER.allow_request():
+                decision.update(model_id=MODEL_FLASH_ID, reason="pro_cooldown")
+            elif probe:
+                decision.update(reason="pro_probe", hedge_after=self.hedge_after() if request_class == "interactive" else None)
+            elif request_class == "interactive" and ROUTER_HEDGE_ENABLED:
+                decision.update(hedge_after=self.hedge_after(), reason="hedged")
+
+        key = f"{request_class}:{decision['reason']}"
+        self.decisions[key] = self.decisions.get(key, 0) + 1
+        self.recent.append({"at": datetime.now(timezone.utc).isoformat(), "class": request_class, **decision})
+        return decision
+
+    def stats(self) -> dict:
+        return {
+            "models": {
+                model_id: {**self.counters[model_id], **self.latency[model_id].summary(), "error_rate": round(self.error_rate(model_id), 3)}
+                for model_id in self.counters
+            },
+            "decisions": self.decisions,
+            "recent": list(self.recent),
+            "config": {
+                "hedge_enabled": ROUTER_HEDGE_ENABLED, "hedge_after_s": self.hedge_after(),
+                "interactive_p95_ms": ROUTER_INTERACTIVE_P95_MS, "max_error_rate": ROUTER_MAX_ERROR_RATE,
+                "min_samples": ROUTER_MIN_SAMPLES, "window": ROUTER_WINDOW,
+                "sample_ttl_s": ROUTER_SAMPLE_TTL_SECONDS, "probe_every": ROUTER_PROBE_EVERY,
+            },
+        }
+
+MODEL_ROUTER = ModelRouter([MODEL_PRO_ID, MODEL_FLASH_ID])
+
+async def call_model(model_id: str, prompt: str, system_instruction: Optional[str], history: Optional[List[dict]],
+                     cached_contents: Optional[Dict[str, str]], response_schema: Optional[dict]) -> str:
+    """Una llamada a un modelo concreto: mide para el router y mantiene el cortocircuito de Pro."""
+    start = time.perf_counter()
     try:
-        contexto_atleta = ""
-        nombre_atleta = "el atleta"
-        
-        if data.athlete_id:
-            athlete = await db.users.find_one({"id": data.athlete_id})
-            if athlete:
-                nombre_atleta = athlete.get('name', 'Atleta')
-                contexto_atleta += f"PERFIL: {nombre_atleta}, Género: {athlete.get('gender', 'N/A')}, Deporte: {athlete.get('sport', 'N/A')}.\n"
-                if athlete.get('is_injured'):
-                    contexto_atleta += f"🚨 ALERTA MÉDICA: El atleta está lesionado/a. Notas: {athlete.get('injury_notes', '')}\n"
-                if athlete.get('equipment'):
-                    contexto_atleta += f"🛠️ MATERIAL DISPONIBLE: {athlete.get('equipment')}\n"
-
-            recent_workouts = await db.workouts.find(
-                {"athlete_id": data.athlete_id, "completed": True}
-            ).sort("date", -1).limit(3).to_list(3)
-            
-            if recent_workouts:
-                contexto_atleta += "\nHISTORIAL RECIENTE (Últimas sesiones completadas):\n"
-                for w in recent_workouts:
-                    rpe = w.get('completion_data', {}).get('rpe', '?')
-                    nombres_ejercicios = [ex.get('name') for ex in w.get('exercises', [])[:3]]
-                    contexto_atleta += f"- {w.get('title')} (RPE reportado: {rpe}/10). Ejercicios: {', '.join(nombres_ejercicios)}...\n"
-                    
-            today = datetime.now(timezone.utc).isoformat().split('T')[0]
-            current_micro = await db.microciclos.find_one({
-                "fecha_inicio": {"$lte": today},
-                "fecha_fin": {"$gte": today}
-            })
-            if current_micro:
-                contexto_atleta += f"\n📅 FASE DE PERIODIZACIÓN ACTUAL: {current_micro.get('nombre')} (Tipo: {current_micro.get('tipo', 'CARGA')}). Adapta la intensidad a esta fase.\n"
-
-        fatiga = data.athleteContext.get('fatigue', '-')
-        dolor = data.athleteContext.get('soreness', '-')
-        fase_ciclo = data.athleteContext.get('cycle_phase', 'No registrada')
-        
-        system_prompt = f"""
+        raw_text = await LLM_PROVIDER.generate(model_id, prompt, system_instruction, history=history,
+                                               cached_content=(cached_contents or {}).get(model_id),
+                                               response_schema=response_schema)
+    except asyncio.CancelledError:
+        MODEL_ROUTER.record_cancel(model_id)
+        raise
+    except Exception as e:
+        quota = is_quota_error(e)
+        MODEL_ROUTER.record(model_id, time.perf_counter() - start, ok=False, quota=quota)
+        if quota and model_id == MODEL_PRO_ID:
+            cooldown_seconds = parse_retry_delay(str(e))
+            logger.warning(f"Cuota de Gemini Pro excedida. Aplicando cooldown de {cooldown_seconds}s.")
+            await PRO_BREAKER.record_failure(cooldown_seconds)
+        raise
+    MODEL_ROUTER.record(model_id, time.perf_counter() - start, ok=True)
+    if model_id == MODEL_PRO_ID:
+        await PRO_BREAKER.record_success()
+    return raw_text
+
+async def hedged_generate(hedge_after: float, *args) -> str:
+    """Pro primero; si no contesta en hedge_after segundos, también Flash. Gana la primera respuesta válida."""
+    pro_task = asyncio.create_task(call_model(MODEL_PRO_ID, *args))
+    done, _ = await asyncio.wait({pro_task}, timeout=hedge_after)
+    if done:
+        return pro_task.result()
+
+    logger.info(f"Pro sin respuesta tras {hedge_after:.1f}s: lanzando Flash en paralelo.")
+    pending = {pro_task, asyncio.create_task(call_model(MODEL_FLASH_ID, *args))}
+    errors = []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                errors.append(task.exception())
+    finally:
+        for task in pending:
+            task.cancel()
+    logger.error(f"Ambos modelos fallaron en petición con cobertura: {[str(e) for e in errors]}")
+    raise HTTPException(status_code=500, detail="Error en IA (ambos modelos fallaron).")
+
+async def generate_with_fallback(prompt: str, system_instruction: Optional[str] = None,
+                                 history: Optional[List[dict]] = None, cached_contents: Optional[Dict[str, str]] = None,
+                                 request_class: str = "interactive", response_schema: Optional[dict] = None) -> str:
+    """Una sola petición al modelo que elija el router; si Pro agota cuota, cooldown y rescate con Flash."""
+    decision = await MODEL_ROUTER.choose(request_class)
+    args = (prompt, system_instruction, history, cached_contents, response_schema)
+
+    if decision['model_id'] == MODEL_FLASH_ID:
+        logger.info(f"Usando modelo Flash ({decision['reason']}).")
+
+    try:
+        if decision['hedge_after'] is not None:
+            return await hedged_generate(decision['hedge_after'], *args)
+        return await call_model(decision['model_id'], *args)
+    except HTTPException:
+        raise
+    except Exception as e:
+        error_str = str(e)
+        if not is_quota_error(e):
+            logger.error(f"Error IA desconocido: {error_str}")
+            raise HTTPException(status_code=500, detail=f"Error conectando con la IA: {error_str}")
+        if decision['model_id'] == MODEL_FLASH_ID:
+            logger.error("Cuota excedida incluso en el modelo Flash.")
+            raise HTTPException(status_code=429, detail="Límite de peticiones alcanzado. Por favor, espera un poco.")
+
+    try:
+        logger.info("Lanzando petición de rescate con modelo Flash...")
+        return await call_model(MODEL_FLASH_ID, *args)
+    except Exception as e_fallback:
+        logger.error(f"Error en modelo Flash de rescate: {str(e_fallback)}")
+        raise HTTPException(status_code=500, detail="Error en IA (ambos modelos fallaron).")
+
+# --- CACHÉ DE RESPUESTAS IA ---
+class BrainResponseCache:
+    """
+    Respuestas ya parseadas de la IA indexadas por el hash del prompt normalizado. LRU en proceso
+    delante de una colección de Mongo con índice TTL, compartida entre workers.
+    """
+
+    def __init__(self, collection, ttl_seconds: int, local_size: int = 256):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.local = TTLCache(maxsize=local_size, ttl=ttl_seconds)
+        self.stats = {"local_hits": 0, "mongo_hits": 0, "misses": 0, "bypassed": 0, "refreshed": 0}
+
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        normalized = [re.sub(r'\s+', ' ', part or '').strip().lower() for part in parts]
+        return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    async def get(self, key: str):
+        cached = self.local.get(key)
+        if cached is not None:
+            self.stats["local_hits"] += 1
+            return cached
+        # El monitor TTL de Mongo pasa cada ~60 s: filtramos por fecha para no servir entradas caducadas
+        min_created = datetime.now(timezone.utc) - timedelta(seconds=self.ttl_seconds)
+        doc = await self.collection.find_one({"_id": key, "created_at": {"$gte": min_created}})
+        if doc:
+            self.stats["mongo_hits"] += 1
+            self.local.set(key, doc["response"])
+            return doc["response"]
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, response):
+        self.local.set(key, response)
+        await self.collection.replace_one(
+            {"_id": key},
+            {"_id": key, "response": response, "created_at": datetime.now(timezone.utc)},
+            upsert=True
+        )
+
+    def summary(self) -> dict:
+        hits = self.stats["local_hits"] + self.stats["mongo_hits"]
+        lookups = hits + self.stats["misses"]
+        return {**self.stats, "hit_rate": round(hits / lookups, 3) if lookups else 0.0, "ttl_seconds": self.ttl_seconds}
+
+BRAIN_CACHE = BrainResponseCache(db.brain_response_cache, BRAIN_CACHE_TTL_SECONDS)
+
+# "prompt": montaje del contexto y el prompt (Mongo); "model": la llamada a la IA, fallback incluido
+BRAIN_LATENCY = {"prompt": LatencySamples(), "model": LatencySamples()}
+
+# --- SALIDA ESTRUCTURADA DE LA IA ---
+# Esquemas OpenAPI que se pasan al modelo como response_schema. Los bloques de ejercicio son
+# heterogéneos (tradicional o HIIT), así que se declara un único objeto con todos los campos.
+_STR = {"type": "string"}
+_EXERCISE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_hiit_block": {"type": "boolean"},
+        "name": _STR, "sets": _STR, "reps": _STR, "duration": _STR,
+        "rest": _STR, "rest_exercise": _STR, "rest_block": _STR, "rest_between_blocks": _STR,
+        "exercise_notes": _STR,
+        "hiit_exercises": {"type": "array", "items": {
+            "type": "object",
+            "properties": {"name": _STR, "sets": _STR, "duration_reps": _STR, "duration": _STR, "exercise_notes": _STR},
+            "required": ["name"],
+        }},
+    },
+    "required": ["name"],
+}
+RESPONSE_SCHEMAS = {
+    "workout": {
+        "type": "object",
+        "properties": {
+            "coach_analysis": _STR,
+            "response_message": _STR,
+            "workoutData": {"type": "object", "properties": {
+                "title": _STR, "notes": _STR, "exercises": {"type": "array", "items": _EXERCISE_SCHEMA},
+            }, "required": ["title", "exercises"]},
+        },
+        "required": ["coach_analysis", "response_message", "workoutData"],
+    },
+    "analytics": {
+        "type": "object",
+        "properties": {"workload_analysis": _STR, "progress_analysis": _STR, "recommendations": {"type": "array", "items": _STR}},
+        "required": ["workload_analysis", "progress_analysis", "recommendations"],
+    },
+    "microcycle": {
+        "type": "object",
+        "properties": {
+            "coach_analysis": _STR,
+            "sessions": {"type": "array", "items": {"type": "object", "properties": {
+                "day": {"type": "integer"}, "title": _STR, "notes": _STR, "exercises": {"type": "array", "items": _EXERCISE_SCHEMA},
+            }, "required": ["day", "title", "exercises"]}},
+        },
+        "required": ["coach_analysis", "sessions"],
+    },
+    "summary": {"type": "object", "properties": {"summary": _STR}, "required": ["summary"]},
+}
+AI_PARSE_STATS = {"clean": 0, "repaired": 0, "failed": 0}
+
+_DANGLING_KEY = re.compile(r'(,|(?<=\{))\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+# Escalar a medio escribir al final del texto: un número (puede faltar algún dígito) o un literal incompleto
+_PARTIAL_SCALAR = re.compile(r'(?<=[,:\[{])\s*(?:-?\d[\d.eE+-]*|t|tr|tru|f|fa|fal|fals|n|nu|nul|-)$')
+
+def _close_truncated_json(text: str) -> str:
+    """
+    Cierra un JSON cortado o con comas colgantes: quita comas antes de } o ], descarta el último
+    valor si el corte cayó dentro de él (cadena, número o literal) junto con su clave, y añade los
+    cierres que falten. Lo que venga después del valor de primer nivel se ignora.
+    """
+    out, stack = [], []
+    in_string = escape = False
+    string_start = 0
+    for ch in text:
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+            string_start = len(out)
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+        elif ch in '}]':
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ',':
+                out.pop()
+            if not stack or stack[-1] != ch:
+                continue
+            stack.pop()
+            out.append(ch)
+            if not stack:
+                break
+            continue
+        out.append(ch)
+
+    if not stack:
+        return ''.join(out)
+    # El corte cayó dentro de un valor: no se completa, se descarta (un "10-1" no es un "10-12" válido)
+    if in_string:
+        result = ''.join(out[:string_start])
+    else:
+        result = _PARTIAL_SCALAR.sub('', ''.join(out).rstrip())
+    while stack:
+        previous = None
+        while previous != result:
+            previous = result
+            result = result.rstrip().rstrip(',')
+            if stack[-1] == '}':
+                result = _DANGLING_KEY.sub('', result)
+            if len(stack) > 1 and result.endswith(('{', '[')):
+                result = result[:-1]  # contenedor anidado que el corte dejó vacío: fuera también
+                stack.pop()
+        result += stack.pop()
+    return result
+
+def repair_json(raw_text: str):
+    """json.loads tolerante: quita vallas ```json, texto alrededor y arregla JSON truncado. Devuelve (valor, reparado)."""
+    text = raw_text.strip()
+    if text.startswith("```"):
+        text = re.sub(r'^```[a-zA-Z]*\s*', '', text)
+        text = re.sub(r'\s*```\s*$', '', text)
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if starts:
+        text = text[min(starts):]
+    try:
+        return json.loads(text), False
+    except ValueError:
+        return json.loads(_close_truncated_json(text)), True
+
+def parse_ai_response(raw_text: str, response_model, allow_truncated: bool = True):
+    """
+    Parsea y valida la respuesta de la IA contra su modelo Pydantic, reparándola en local si hace falta.
+    Con allow_truncated=False una respuesta que hubo que cerrar se rechaza con 502 en vez de aprovecharse.
+    """
+    try:
+        data, repaired = repair_json(raw_text)
+        if not isinstance(data, dict):
+            raise ValueError("la respuesta no es un objeto JSON")
+        result = response_model(**data).dict()
+    except Exception as e:
+        AI_PARSE_STATS["failed"] += 1
+        logger.error(f"Respuesta de IA no válida ({response_model.__name__}): {str(e)}. Inicio: {raw_text[:200]!r}")
+        raise HTTPException(status_code=500, detail="La IA devolvió una respuesta no válida. Inténtalo de nuevo.")
+    if repaired and not allow_truncated:
+        AI_PARSE_STATS["failed"] += 1
+        logger.error(f"Respuesta de IA cortada rechazada ({response_model.__name__}). Final: {raw_text[-200:]!r}")
+        raise HTTPException(status_code=502, detail="La respuesta de la IA llegó incompleta. Inténtalo de nuevo.")
+    AI_PARSE_STATS["repaired" if repaired else "clean"] += 1
+    if repaired:
+        logger.warning(f"Respuesta de IA reparada en local ({response_model.__name__}).")
+    return result
+
+# --- ÍNDICE DE SIMILITUD DE LA MEMORIA IA ---
+# TF-IDF en memoria sobre títulos, ejercicios y notas de brain_memory, con índice invertido:
+# solo se puntúan las sesiones que comparten algún término con la consulta. Sin servicios externos.
+_MEMORY_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_MEMORY_STOPWORDS = {
+    "de", "la", "el", "en", "y", "a", "con", "los", "las", "del", "al", "un", "una", "por", "para",
+    "sin", "se", "su", "sus", "o", "que", "lo", "es", "x", "s", "m", "the", "and", "of",
+}
+MAX_FEW_SHOT_EXERCISES = 8
+
+def tokenize_memory_text(text: str) -> List[str]:
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in _MEMORY_TOKEN_RE.findall(text) if len(t) > 1 and t not in _MEMORY_STOPWORDS]
+
+def _memory_exercise_names(exercises: list) -> List[str]:
+    names = []
+    for ex in exercises or []:
+        if not isinstance(ex, dict):
+            continue
+        names.append(ex.get('name') or '')
+        names.extend(h.get('name') or '' for h in ex.get('hiit_exercises') or [] if isinstance(h, dict))
+    return [n for n in names if n]
+
+def render_memory_example(doc: dict) -> str:
+    parts = []
+    for ex in (doc.get('exercises') or [])[:MAX_FEW_SHOT_EXERCISES]:
+        if not isinstance(ex, dict):
+            continue
+        if ex.get('is_hiit_block'):
+            inner = ", ".join(h.get('name', '') for h in ex.get('hiit_exercises') or [] if isinstance(h, dict))
+            parts.append(f"{ex.get('name', 'HIIT')} [{ex.get('sets', '?')} rondas: {inner}]")
+        else:
+            dose = ex.get('reps') or ex.get('duration') or '?'
+            parts.append(f"{ex.get('name', '')} {ex.get('sets', '?')}x{dose}" + (f" ({ex['rest']})" if ex.get('rest') else ""))
+    return f"{doc.get('title') or 'Sesión'}: " + "; ".join(parts)
+
+class _MemoryShard:
+    """TF-IDF de las sesiones de un entrenador.
+
+    Las normas de cada sesión se calculan con el IDF del momento en que entra; la deriva por altas
+    posteriores es pequeña y se corrige en cada rebuild() diario.
+    """
+
+    def __init__(self):
+        self.examples: Dict[str, str] = {}
+        self.norms: Dict[str, float] = {}
+        self.postings: Dict[str, Dict[str, float]] = defaultdict(dict)  # término -> {content_hash: peso tf}
+
+    @staticmethod
+    def _terms(doc: dict) -> Counter:
+        text = " ".join([doc.get('title') or '', doc.get('notes') or ''] + _memory_exercise_names(doc.get('exercises')))
+        text += " " + " ".join(ex.get('exercise_notes') or '' for ex in doc.get('exercises') or [] if isinstance(ex, dict))
+        return Counter(tokenize_memory_text(text))
+
+    def _idf(self, term: str) -> float:
+        return math.log((1 + len(self.examples)) / (1 + len(self.postings.get(term, ())))) + 1
+
+    def load(self, content_hash: str, doc: dict) -> Optional[Counter]:
+        if content_hash in self.examples:
+            return None
+        terms = self._terms(doc)
+        if not terms:
+            return None
+        self.examples[content_hash] = render_memory_example(doc)
+        for term, c in terms.items():
+            self.postings[term][content_hash] = 1 + math.log(c)
+        return terms
+
+    def add(self, content_hash: str, doc: dict):
+        terms = self.load(content_hash, doc)
+        if terms:
+            self.norms[content_hash] = math.sqrt(sum((self.postings[t][content_hash] * self._idf(t)) ** 2 for t in terms))
+
+    def remove(self, content_hash: str):
+        if self.examples.pop(content_hash, None) is None:
+            return
+        self.norms.pop(content_hash, None)
+        for term in [t for t, docs in self.postings.items() if docs.pop(content_hash, None) is not None and not docs]:
+            del self.postings[term]
+
+    def finalize(self):
+        """Normas de todas las sesiones con el IDF definitivo, tras una carga completa."""
+        sq = defaultdict(float)
+        for term, docs in self.postings.items():
+            idf = self._idf(term)
+            for content_hash, w in docs.items():
+                sq[content_hash] += (w * idf) ** 2
+        self.norms = {h: math.sqrt(v) for h, v in sq.items()}
+
+    def search(self, text: str, k: int, min_score: float) -> List[str]:
+        query = {t: (1 + math.log(c)) * self._idf(t) for t, c in Counter(tokenize_memory_text(text)).items() if t in self.postings}
+        if not query:
+            return []
+        query_norm = math.sqrt(sum(w * w for w in query.values()))
+        scores = defaultdict(float)
+        for term, qw in query.items():
+            idf = self._idf(term)
+            for content_hash, w in self.postings[term].items():
+                scores[content_hash] += qw * w * idf
+        best = heapq.nlargest(k, ((score / (query_norm * self.norms[h]), h) for h, score in scores.items()))
+        return [self.examples[h] for score, h in best if score >= min_score]
+
+class BrainMemoryIndex:
+    """Un _MemoryShard por entrenador: cada uno solo recupera sus propias sesiones.
+    add()/remove() son incrementales; rebuild() sustituye todos los shards de una vez."""
+
+    def __init__(self):
+        self.shards: Dict[str, _MemoryShard] = {}
+        self.search_latency = LatencySamples()
+        self.stats = {"builds": 0, "last_build_ms": None, "searches": 0, "hits": 0}
+
+    def add(self, trainer_id: Optional[str], content_hash: str, doc: dict):
+        if trainer_id:
+            self.shards.setdefault(trainer_id, _MemoryShard()).add(content_hash, doc)
+
+    def remove(self, trainer_id: Optional[str], content_hash: Optional[str]):
+        if trainer_id in self.shards and content_hash:
+            self.shards[trainer_id].remove(content_hash)
+
+    async def rebuild(self):
+        start = time.perf_counter()
+        shards = {}
+        async for doc in db.brain_memory.find(
+            {"trainer_id": {"$ne": None}, "content_hash": {"$exists": True}},
+            {"_id": 0, "trainer_id": 1, "content_hash": 1, "title": 1, "notes": 1, "exercises": 1}
+        ):
+            shards.setdefault(doc['trainer_id'], _MemoryShard()).load(doc['content_hash'], doc)
+        for shard in shards.values():
+            shard.finalize()
+        self.shards = shards
+        self.stats["builds"] += 1
+        self.stats["last_build_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        logger.info(f"Índice de memoria IA construido: {sum(len(s.examples) for s in shards.values())} sesiones de {len(shards)} entrenadores en {self.stats['last_build_ms']} ms.")
+
+    def search(self, trainer_id: Optional[str], text: str, k: int, min_score: float = 0.0) -> List[str]:
+        start = time.perf_counter()
+        shard = self.shards.get(trainer_id)
+        results = shard.search(text, k, min_score) if shard else []
+        self.stats["searches"] += 1
+        self.stats["hits"] += bool(results)
+        self.search_latency.add(time.perf_counter() - start)
+        return results
+
+    def summary(self) -> dict:
+        return {
+            **self.stats,
+            "trainers": len(self.shards),
+            "sessions": sum(len(s.examples) for s in self.shards.values()),
+            "terms": sum(len(s.postings) for s in self.shards.values()),
+            "search_latency": self.search_latency.summary(),
+        }
+
+BRAIN_MEMORY_INDEX = BrainMemoryIndex()
+
+@app.on_event("startup")
+async def build_brain_memory_index():
+    asyncio.create_task(BRAIN_MEMORY_INDEX.rebuild())
+
+def render_few_shot_examples(trainer_id: Optional[str], query: str) -> str:
+    if BRAIN_FEW_SHOT_K <= 0 or not trainer_id:
+        return ""
+    examples = BRAIN_MEMORY_INDEX.search(trainer_id, query, BRAIN_FEW_SHOT_K, BRAIN_FEW_SHOT_MIN_SCORE)
+    if not examples:
+        return ""
+    lines = "\n".join(f"        - {e}" for e in examples)
+    return f"""
+        SESIONES DE REFERENCIA DEL ENTRENADOR (sesiones parecidas que ya ha programado; imita su estilo, selección de ejercicios y dosis, sin copiarlas):
+{lines}
+        """
+
+# --- CONTEXTO DEL ATLETA PARA PROMPTS ---
+async def find_current_phase(athlete_id: str, today: str) -> Optional[dict]:
+    """Microciclo vigente del atleta: solo entre los de sus macrociclos (índice macrociclo_fechas)."""
+    macro_ids = await db.macrociclos.distinct("id", {"athlete_id": athlete_id})
+    if not macro_ids:
+        return None
+    return await db.microciclos.find_one(
+        {"macrociclo_id": {"$in": macro_ids}, "fecha_inicio": {"$lte": today}, "fecha_fin": {"$gte": today}},
+        {"_id": 0, "nombre": 1, "tipo": 1}
+    )
+
+async def build_athlete_context(athlete_id: str) -> AthleteContext:
+    """Perfil, últimas 3 sesiones completadas y fase actual, las tres lecturas en paralelo."""
+    today = datetime.now(timezone.utc).isoformat().split('T')[0]
+    athlete, recent_workouts, micro = await asyncio.gather(
+        db.users.find_one(
+            {"id": athlete_id},
+            {"_id": 0, "name": 1, "gender": 1, "sport": 1, "is_injured": 1, "injury_notes": 1, "equipment": 1, "trainer_id": 1}
+        ),
+        db.workouts.find(
+            {"athlete_id": athlete_id, "completed": True},
+            {"_id": 0, "title": 1, "completion_data.rpe": 1, "exercises.name": 1}
+        ).sort("date", -1).limit(3).to_list(3),
+        find_current_phase(athlete_id, today),
+    )
+
+    context = AthleteContext()
+    if athlete:
+        context.found = True
+        context.name = athlete.get('name', 'Atleta')
+        context.gender = athlete.get('gender')
+        context.sport = athlete.get('sport')
+        context.is_injured = bool(athlete.get('is_injured'))
+        context.injury_notes = athlete.get('injury_notes')
+        context.equipment = athlete.get('equipment')
+        context.trainer_id = athlete.get('trainer_id')
+    context.recent_sessions = [
+        RecentSession(
+            title=w.get('title'),
+            rpe=w.get('completion_data', {}).get('rpe', '?'),
+            exercises=[ex.get('name') for ex in w.get('exercises', [])[:3]]
+        )
+        for w in recent_workouts
+    ]
+    if micro:
+        context.current_phase = CurrentPhase(nombre=micro.get('nombre'), tipo=micro.get('tipo') or 'CARGA')
+    return context
+
+def render_athlete_context(context: AthleteContext) -> str:
+    texto = ""
+    if context.found:
+        texto += f"PERFIL: {context.name}, Género: {context.gender or 'N/A'}, Deporte: {context.sport or 'N/A'}.\n"
+        if context.is_injured:
+            texto += f"🚨 ALERTA MÉDICA: El atleta está lesionado/a. Notas: {context.injury_notes or ''}\n"
+        if context.equipment:
+            texto += f"🛠️ MATERIAL DISPONIBLE: {context.equipment}\n"
+    if context.recent_sessions:
+        texto += "\nHISTORIAL RECIENTE (Últimas sesiones completadas):\n"
+        for w in context.recent_sessions:
+            texto += f"- {w.title} (RPE reportado: {w.rpe}/10). Ejercicios: {', '.join(str(n) for n in w.exercises)}...\n"
+    if context.current_phase:
+        texto += f"\n📅 FASE DE PERIODIZACIÓN ACTUAL: {context.current_phase.nombre} (Tipo: {context.current_phase.tipo}). Adapta la intensidad a esta fase.\n"
+    return texto
+
+async def build_workout_system_prompt(data: GeminiChatRequest, trainer_id: Optional[str]) -> str:
+    """trainer_id es el del entrenador que pide la sesión: de su memoria salen los ejemplos."""
+    contexto_atleta = ""
+    nombre_atleta = "el atleta"
+    consulta_memoria = [data.userMessage]
+
+    if data.athlete_id:
+        context = await build_athlete_context(data.athlete_id)
+        nombre_atleta = context.name
+        contexto_atleta = render_athlete_context(context)
+        consulta_memoria += [context.sport or '', context.injury_notes or '']
+        if context.current_phase:
+            consulta_memoria += [context.current_phase.nombre or '', context.current_phase.tipo or '']
+
+    fatiga = data.athleteContext.get('fatigue', '-')
+    dolor = data.athleteContext.get('soreness', '-')
+    fase_ciclo = data.athleteContext.get('cycle_phase', 'No registrada')
+    ejemplos = render_few_shot_examples(trainer_id, " ".join(consulta_memoria))
+
+    return f"""
         Eres un preparador físico de élite y experto en alto rendimiento.
         Estás diseñando una sesión para {nombre_atleta}.
         Tu tono es conversacional, cercano, empático pero muy profesional y basado en la ciencia deportiva. 
@@ -434,7 +2000,7 @@ async def generate_workout_api(data: GeminiChatRequest, user=Depends(get_current
         
         ESTADO HOY: 
         Fatiga {fatiga}/5, Dolor/Agujetas {dolor}/5. Fase del ciclo: {fase_ciclo}.
-        
+        {ejemplos}
         RESPONDE ÚNICAMENTE CON JSON PURO USANDO ESTA ESTRUCTURA EXACTA. 
         Tienes dos formas de crear bloques dentro de "exercises": TRADICIONAL (Fuerza) o HIIT (Circuito). Puedes mezclarlos.
 
@@ -477,73 +2043,14 @@ async def generate_workout_api(data: GeminiChatRequest, user=Depends(get_current
         }}
         """
 
-        model_pro_id = "models/gemini-3.1-pro-preview"
-        model_flash_id = "models/gemini-2.5-flash"
-        
-        intentar_pro = time.time() > COOLDOWN_PRO_UNTIL
-        modelo_actual_id = model_pro_id if intentar_pro else model_flash_id
-        
-        if not intentar_pro:
-            tiempo_restante = int(COOLDOWN_PRO_UNTIL - time.time())
-            logger.info(f"Usando modelo Flash (Pro en cooldown por {tiempo_restante}s más).")
-
-        try:
-            model = genai.GenerativeModel(model_name=modelo_actual_id)
-            model.generation_config = {"response_mime_type": "application/json"}
-            chat = model.start_chat(history=[])
-            chat.send_message(system_prompt)
-            response = chat.send_message(data.userMessage)
-            
-        except Exception as e:
-            error_str = str(e)
-            if "429" in error_str or "Quota" in error_str or isinstance(e, ResourceExhausted):
-                if intentar_pro:
-                    cooldown_seconds = 60
-                    match = re.search(r'retry_delay\s*\{\s*seconds:\s*(\d+)\s*\}', error_str)
-                    if match:
-                        cooldown_seconds = int(match.group(1)) + 5
-                        
-                    logger.warning(f"Cuota de Gemini Pro excedida. Aplicando cooldown de {cooldown_seconds}s. Cambiando a Flash...")
-                    COOLDOWN_PRO_UNTIL = time.time() + cooldown_seconds
-                    
-                    try:
-                        logger.info("Lanzando petición de rescate con modelo Flash...")
-                        model_fallback = genai.GenerativeModel(model_name=model_flash_id)
-                        model_fallback.generation_config = {"response_mime_type": "application/json"}
-                        chat = model_fallback.start_chat(history=[])
-                        chat.send_message(system_prompt)
-                        response = chat.send_message(data.userMessage)
-                    except Exception as e_fallback:
-                        logger.error(f"Error en modelo Flash de rescate: {str(e_fallback)}")
-                        raise HTTPException(status_code=500, detail="Error en IA (ambos modelos fallaron).")
-                else:
-                    logger.error("Cuota excedida incluso en el modelo Flash.")
-                    raise HTTPException(status_code=429, detail="Límite de peticiones alcanzado. Por favor, espera un poco.")
-            else:
-                logger.error(f"Error IA desconocido: {error_str}")
-                raise HTTPException(status_code=500, detail=f"Error conectando con la IA: {error_str}")
-
-        raw_text = response.text.strip()
-        if raw_text.startswith("```"):
-            raw_text = raw_text.replace("```json", "").replace("```", "").strip()
-        
-        return json.loads(raw_text)
-        
-    except Exception as e:
-        logger.error(f"Error general en endpoint IA: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error conectando con la IA: {str(e)}")
-
-@api_router.post("/brain/analyze-analytics")
-async def analyze_analytics_api(data: AnalyticsAnalyzeRequest, user=Depends(get_current_user)):
-    global COOLDOWN_PRO_UNTIL
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="API de Gemini no configurada.")
-        
-    try:
-        system_prompt = f"""
+async def build_analytics_prompt(data: AnalyticsAnalyzeRequest) -> str:
+    contexto_atleta = ""
+    if data.athlete_id:
+        contexto_atleta = render_athlete_context(await build_athlete_context(data.athlete_id))
+    return f"""
         Eres un preparador físico de élite analizando los datos recientes de {data.athlete_name}.
         Analiza estos datos con un tono muy profesional, directo y científico.
-        
+        {contexto_atleta}
         Datos de los últimos 14 días:
         - Curva de Fatiga (0-5): {data.fatigue_data}
         - Curva de Agujetas/Dolor (0-5): {data.soreness_data}
@@ -558,36 +2065,798 @@ async def analyze_analytics_api(data: AnalyticsAnalyzeRequest, user=Depends(get_
         }}
         """
 
-        model_pro_id = "models/gemini-3.1-pro-preview"
-        model_flash_id = "models/gemini-2.5-flash"
-        
-        intentar_pro = time.time() > COOLDOWN_PRO_UNTIL
-        modelo_actual_id = model_pro_id if intentar_pro else model_flash_id
+@api_router.get("/brain/status")
+async def get_brain_status(user=Depends(get_current_user)):
+    if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
+    return {"provider": LLM_PROVIDER.name, "breakers": {PRO_BREAKER.name: await PRO_BREAKER.status()}}
 
+@api_router.get("/brain/router")
+async def get_brain_router(user=Depends(get_current_user)):
+    """Estadísticas y últimas decisiones del router de modelos de este worker, para afinar umbrales."""
+    if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
+    return {"worker": WORKER_ID, **MODEL_ROUTER.stats()}
+
+# --- CONVERSACIONES DEL CHAT IA ---
+# El historial vive en brain_conversations: el cliente solo manda el mensaje nuevo. El system prompt
+# se monta una vez al crear la conversación y, cuando el historial supera CHAT_HISTORY_TOKEN_BUDGET,
+# los turnos antiguos se resumen con Flash en segundo plano.
+CONVERSATION_STATS = {"created": 0, "turns": 0, "summaries": 0, "summary_failures": 0, "context_caches": 0}
+
+def summarize_prompt(summary: str, turns: List[dict]) -> str:
+    dialogo = "\n".join(f"{'ENTRENADOR' if t['role'] == 'user' else 'IA'}: {t['text']}" for t in turns)
+    return f"""
+        Resume esta conversación entre un entrenador y su asistente de IA deportiva para poder continuarla.
+        Conserva decisiones tomadas, preferencias, lesiones, material y sesiones ya propuestas. Máximo 150 palabras.
+
+        RESUMEN PREVIO: {summary or 'Ninguno'}
+
+        CONVERSACIÓN:
+        {dialogo}
+
+        RESPONDE ÚNICAMENTE CON JSON PURO: {{"summary": "texto del resumen"}}
+        """
+
+def conversation_history(conversation: dict) -> List[dict]:
+    history = []
+    if conversation.get('summary'):
+        history.append({"role": "user", "parts": [f"Resumen de la conversación hasta ahora: {conversation['summary']}"]})
+        history.append({"role": "model", "parts": ["Entendido, continúo a partir de ahí."]})
+    history.extend({"role": t['role'], "parts": [t['text']]} for t in conversation.get('turns', []))
+    return history
+
+def conversation_tokens(conversation: dict) -> int:
+    return estimate_tokens(conversation.get('summary')) + sum(estimate_tokens(t['text']) for t in conversation.get('turns', []))
+
+async def compact_conversation(conversation_id: str):
+    """Resume los turnos antiguos si el historial se pasa del presupuesto. Si el resumen falla, se descartan igualmente."""
+    conversation = await db.brain_conversations.find_one({"id": conversation_id}, {"_id": 0})
+    if not conversation or conversation_tokens(conversation) <= CHAT_HISTORY_TOKEN_BUDGET:
+        return
+    turns = conversation['turns']
+    old, keep = turns[:-CHAT_KEEP_RECENT_TURNS], turns[-CHAT_KEEP_RECENT_TURNS:]
+    if not old:
+        return
+
+    summary = conversation.get('summary', '')
+    try:
+        raw_text = await LLM_PROVIDER.generate(MODEL_FLASH_ID, summarize_prompt(summary, old), response_schema=RESPONSE_SCHEMAS["summary"])
+        summary = parse_ai_response(raw_text, SummaryAIResponse)['summary'] or summary
+        CONVERSATION_STATS["summaries"] += 1
+    except Exception as e:
+        CONVERSATION_STATS["summary_failures"] += 1
+        logger.warning(f"No se pudo resumir la conversación {conversation_id}: {str(e)}")
+
+    # Solo si nadie ha añadido turnos desde que la leímos; si no, lo reintenta el siguiente turno
+    await db.brain_conversations.update_one(
+        {"id": conversation_id, "turn_count": conversation['turn_count']},
+        {"$set": {"summary": summary, "turns": keep}}
+    )
+
+async def get_owned_conversation(conversation_id: str, user: dict, projection: Optional[dict] = None) -> dict:
+    conversation = await db.brain_conversations.find_one({"id": conversation_id, "owner_id": user['id']}, projection or {"_id": 0})
+    if not conversation: raise HTTPException(status_code=404, detail="Conversación no encontrada")
+    return conversation
+
+async def run_conversation_turn(data: GeminiChatRequest, request_class: str = "interactive") -> dict:
+    if len(data.userMessage) > CHAT_MAX_MESSAGE_CHARS:
+        raise HTTPException(status_code=400, detail="Mensaje demasiado largo")
+    conversation = await db.brain_conversations.find_one({"id": data.conversation_id}, {"_id": 0})
+    if not conversation: raise HTTPException(status_code=404, detail="Conversación no encontrada")
+
+    now = datetime.now(timezone.utc)
+    cached_contents = {
+        model_id: cache['name'] for model_id, cache in conversation.get('context_caches', {}).items()
+        if cache['expires_at'].replace(tzinfo=timezone.utc) > now + timedelta(seconds=30)
+    }
+    start = time.perf_counter()
+    raw_text = await generate_with_fallback(
+        data.userMessage, system_instruction=conversation['system_prompt'],
+        history=conversation_history(conversation), cached_contents=cached_contents, request_class=request_class,
+        response_schema=RESPONSE_SCHEMAS["workout"]
+    )
+    BRAIN_LATENCY["model"].add(time.perf_counter() - start)
+    result = parse_ai_response(raw_text, WorkoutAIResponse)
+
+    # Del turno del modelo se guarda el mensaje y el título de la sesión, no el JSON entero
+    reply = result.get('response_message') or ''
+    if isinstance(result.get('workoutData'), dict) and result['workoutData'].get('title'):
+        reply += f" [Sesión propuesta: {result['workoutData']['title']}]"
+    updated = await db.brain_conversations.find_one_and_update(
+        {"id": conversation['id']},
+        {
+            "$push": {"turns": {"$each": [{"role": "user", "text": data.userMessage}, {"role": "model", "text": reply}]}},
+            "$inc": {"turn_count": 2},
+            "$set": {"updated_at": now.isoformat(), "last_active_at": now},
+        },
+        projection={"_id": 0, "summary": 1, "turns": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    CONVERSATION_STATS["turns"] += 1
+    if updated and conversation_tokens(updated) > CHAT_HISTORY_TOKEN_BUDGET:
+        asyncio.create_task(compact_conversation(conversation['id']))
+    return {**result, "conversation_id": conversation['id']}
+
+@api_router.post("/brain/conversations")
+async def create_conversation(data: ConversationCreate, user=Depends(get_current_user)):
+    if not LLM_PROVIDER.is_configured():
+        raise HTTPException(status_code=500, detail="API de Gemini no configurada.")
+    system_prompt = await build_workout_system_prompt(GeminiChatRequest(userMessage="", athleteContext=data.athleteContext, athlete_id=data.athlete_id),
+                                                      resolve_trainer_id(user))
+
+    context_caches = {}
+    names = await asyncio.gather(*(LLM_PROVIDER.cache_context(model_id, system_prompt, CHAT_CONTEXT_CACHE_TTL_SECONDS) for model_id in (MODEL_PRO_ID, MODEL_FLASH_ID)))
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=CHAT_CONTEXT_CACHE_TTL_SECONDS)
+    for model_id, name in zip((MODEL_PRO_ID, MODEL_FLASH_ID), names):
+        if name:
+            context_caches[model_id] = {"name": name, "expires_at": expires_at}
+            CONVERSATION_STATS["context_caches"] += 1
+
+    now = datetime.now(timezone.utc)
+    conversation = {
+        "id": str(uuid.uuid4()), "owner_id": user['id'], "athlete_id": data.athlete_id,
+        "system_prompt": system_prompt, "summary": "", "turns": [], "turn_count": 0,
+        "context_caches": context_caches, "created_at": now.isoformat(), "updated_at": now.isoformat(), "last_active_at": now,
+    }
+    await db.brain_conversations.insert_one(conversation)
+    CONVERSATION_STATS["created"] += 1
+    return {"conversation_id": conversation['id'], "created_at": conversation['created_at']}
+
+@api_router.get("/brain/conversations/{conversation_id}")
+async def get_conversation(conversation_id: str, user=Depends(get_current_user)):
+    conversation = await get_owned_conversation(conversation_id, user, {"_id": 0, "system_prompt": 0, "context_caches": 0, "last_active_at": 0})
+    return {"conversation_id": conversation.pop('id'), **conversation}
+
+@api_router.delete("/brain/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str, user=Depends(get_current_user)):
+    conversation = await get_owned_conversation(conversation_id, user, {"_id": 0, "context_caches": 1})
+    await db.brain_conversations.delete_one({"id": conversation_id})
+    for cache in conversation.get('context_caches', {}).values():
+        await LLM_PROVIDER.drop_context(cache['name'])
+    return {"status": "success"}
+
+async def run_generate_workout(data: GeminiChatRequest, trainer_id: Optional[str], request_class: str = "interactive") -> dict:
+    if data.conversation_id:
+        return await run_conversation_turn(data, request_class)
+    start = time.perf_counter()
+    system_prompt = await build_workout_system_prompt(data, trainer_id)
+    BRAIN_LATENCY["prompt"].add(time.perf_counter() - start)
+    cache_key = BRAIN_CACHE.make_key(system_prompt, data.userMessage)
+    if data.bypass_cache:
+        BRAIN_CACHE.stats["bypassed"] += 1
+    elif data.refresh_cache:
+        BRAIN_CACHE.stats["refreshed"] += 1
+    else:
+        cached = await BRAIN_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+
+    # El prompt de sistema va como system instruction: una única petición en vez de dos mensajes de chat
+    start = time.perf_counter()
+    raw_text = await generate_with_fallback(data.userMessage, system_instruction=system_prompt, request_class=request_class,
+                                            response_schema=RESPONSE_SCHEMAS["workout"])
+    BRAIN_LATENCY["model"].add(time.perf_counter() - start)
+    result = parse_ai_response(raw_text, WorkoutAIResponse)
+    if not data.bypass_cache:
+        await BRAIN_CACHE.set(cache_key, result)
+    return result
+
+@api_router.post("/brain/generate-workout")
+async def generate_workout_api(data: GeminiChatRequest, response: Response, job: bool = Query(False), user=Depends(get_current_user)):
+    if not LLM_PROVIDER.is_configured():
+        raise HTTPException(status_code=500, detail="API de Gemini no configurada.")
+    if data.conversation_id:
+        await get_owned_conversation(data.conversation_id, user, {"_id": 0, "id": 1})
+    if job:
+        response.status_code = 202
+        return await enqueue_brain_job("generate-workout", data.dict(), user)
+
+    try:
+        return await run_generate_workout(data, resolve_trainer_id(user))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error general en endpoint IA: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error conectando con la IA: {str(e)}")
+
+def sse_event(event: str, payload) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@api_router.post("/brain/generate-workout/stream")
+async def generate_workout_stream_api(data: GeminiChatRequest, user=Depends(get_current_user)):
+    """
+    Variante SSE de generate-workout: eventos 'token' con el texto según lo genera el modelo y un
+    evento final 'workoutData' con el mismo JSON validado que devuelve el endpoint normal.
+    """
+    if not LLM_PROVIDER.is_configured():
+        raise HTTPException(status_code=500, detail="API de Gemini no configurada.")
+
+    async def event_stream():
+        yield sse_event("status", {"stage": "context"})
         try:
-            model = genai.GenerativeModel(model_name=modelo_actual_id)
-            model.generation_config = {"response_mime_type": "application/json"}
-            response = model.generate_content(system_prompt)
+            start = time.perf_counter()
+            system_prompt = await build_workout_system_prompt(data, resolve_trainer_id(user))
+            BRAIN_LATENCY["prompt"].add(time.perf_counter() - start)
+            cache_key = BRAIN_CACHE.make_key(system_prompt, data.userMessage)
+            if not (data.bypass_cache or data.refresh_cache):
+                cached = await BRAIN_CACHE.get(cache_key)
+                if cached is not None:
+                    yield sse_event("workoutData", cached)
+                    yield sse_event("done", {"cached": True})
+                    return
+
+            chunks = []
+            async for event, payload in stream_with_fallback(data.userMessage, system_instruction=system_prompt,
+                                                             response_schema=RESPONSE_SCHEMAS["workout"]):
+                if event == "token":
+                    chunks.append(payload)
+                    yield sse_event("token", {"text": payload})
+                else:
+                    yield sse_event(event, {"id": payload})
+
+            result = parse_ai_response("".join(chunks), WorkoutAIResponse)
+            chunks.clear()
+            if not data.bypass_cache:
+                await BRAIN_CACHE.set(cache_key, result)
+            yield sse_event("workoutData", result)
+            yield sse_event("done", {"cached": False})
+        except HTTPException as e:
+            yield sse_event("error", {"status": e.status_code, "detail": e.detail})
         except Exception as e:
-            # CORRECCIÓN BUG 1 APLICADA AQUÍ (isinstance sin comillas)
-            if intentar_pro and ("429" in str(e) or "Quota" in str(e) or isinstance(e, ResourceExhausted)):
-                COOLDOWN_PRO_UNTIL = time.time() + 60
-                model_fallback = genai.GenerativeModel(model_name=model_flash_id)
-                model_fallback.generation_config = {"response_mime_type": "application/json"}
-                response = model_fallback.generate_content(system_prompt)
-            else:
-                raise e
+            logger.error(f"Error general en streaming IA: {str(e)}")
+            yield sse_event("error", {"status": 500, "detail": f"Error conectando con la IA: {str(e)}"})
 
-        raw_text = response.text.strip()
-        if raw_text.startswith("```"):
-            raw_text = raw_text.replace("```json", "").replace("```", "").strip()
-        
-        return json.loads(raw_text)
-        
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def run_analyze_analytics(data: AnalyticsAnalyzeRequest) -> dict:
+    start = time.perf_counter()
+    prompt = await build_analytics_prompt(data)
+    BRAIN_LATENCY["prompt"].add(time.perf_counter() - start)
+    start = time.perf_counter()
+    raw_text = await generate_with_fallback(prompt, request_class="batch", response_schema=RESPONSE_SCHEMAS["analytics"])
+    BRAIN_LATENCY["model"].add(time.perf_counter() - start)
+    return parse_ai_response(raw_text, AnalyticsAIResponse)
+
+@api_router.post("/brain/analyze-analytics")
+async def analyze_analytics_api(data: AnalyticsAnalyzeRequest, response: Response, job: bool = Query(False), user=Depends(get_current_user)):
+    if not LLM_PROVIDER.is_configured():
+        raise HTTPException(status_code=500, detail="API de Gemini no configurada.")
+    if job:
+        response.status_code = 202
+        return await enqueue_brain_job("analyze-analytics", data.dict(), user)
+
+    try:
+        return await run_analyze_analytics(data)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error en analíticas IA: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error conectando con la IA: {str(e)}")
 
+# --- ANALÍTICAS CALCULADAS EN SERVIDOR ---
+ANALYTICS_CURVE_DAYS = 14
+ANALYTICS_COUNT_DAYS = 30
+ANALYTICS_TOP_PRS = 5
+ANALYTICS_MEMO_STATS = {"hits": 0, "misses": 0}
+
+def _to_number(expr):
+    """Convierte a número dentro de un aggregate: "80,5" -> 80.5; vacío o texto no numérico -> 0."""
+    return {"$convert": {
+        "input": {"$replaceAll": {"input": {"$toString": {"$ifNull": [expr, "0"]}}, "find": ",", "replacement": "."}},
+        "to": "double", "onError": 0.0, "onNull": 0.0,
+    }}
+
+async def top_personal_records(athlete_id: str) -> List[str]:
+    """Mejores marcas del atleta (tests + resultados registrados en sesiones), agrupadas por nombre."""
+    tests_pipeline = [
+        {"$match": {"athlete_id": athlete_id, "test_type": {"$ne": "medicion"}}},
+        {"$project": {
+            "_id": 0,
+            "name": {"$ifNull": [{"$cond": [{"$eq": ["$custom_name", ""]}, None, "$custom_name"]}, "$test_name"]},
+            "unit": {"$ifNull": ["$unit", "kg"]},
+            "val": {"$max": [_to_number("$value"), _to_number("$value_left"), _to_number("$value_right")]},
+        }},
+    ]
+    workouts_pipeline = [
+        {"$match": {"athlete_id": athlete_id, "completed": True}},
+        {"$project": {"_id": 0, "is_test_battery": 1, "results": "$completion_data.exercise_results"}},
+        {"$unwind": "$results"},
+        {"$match": {"results.name": {"$nin": [None, ""]}, "$or": [{"results.completed_sets": {"$gt": 0}}, {"is_test_battery": True}]}},
+        {"$project": {
+            "name": "$results.name",
+            "unit": {"$ifNull": ["$results.unit", {"$cond": ["$is_test_battery", "", "kg"]}]},
+            "val": {"$max": [
+                _to_number({"$ifNull": ["$results.logged_weight", "$results.value"]}),
+                _to_number({"$ifNull": ["$results.logged_weight_left", "$results.value_left"]}),
+                _to_number({"$ifNull": ["$results.logged_weight_right", "$results.value_right"]}),
+            ]},
+        }},
+    ]
+    group_stages = [
+        {"$match": {"val": {"$gt": 0}}},
+        {"$group": {"_id": {"$toLower": {"$trim": {"input": "$name"}}}, "name": {"$first": "$name"}, "unit": {"$first": "$unit"}, "best": {"$max": "$val"}}},
+    ]
+    from_tests, from_workouts = await asyncio.gather(
+        db.tests.aggregate(tests_pipeline + group_stages).to_list(None),
+        db.workouts.aggregate(workouts_pipeline + group_stages).to_list(None),
+    )
+    best = {}
+    for record in from_tests + from_workouts:
+        if record['_id'] not in best or record['best'] > best[record['_id']]['best']:
+            best[record['_id']] = record
+    ranked = sorted(best.values(), key=lambda r: r['best'], reverse=True)[:ANALYTICS_TOP_PRS]
+    return [f"{r['name'].strip()}: {r['best']:g}{r['unit']}" for r in ranked]
+
+async def collect_analytics_inputs(athlete_id: str) -> dict:
+    """Lo mismo que montaba la app en analytics.tsx: curvas de 14 días, sesiones de 30 días y PRs."""
+    today = datetime.now(timezone.utc).date()
+    days = [(today - timedelta(days=i)).isoformat() for i in range(ANALYTICS_CURVE_DAYS - 1, -1, -1)]
+    since_count = (today - timedelta(days=ANALYTICS_COUNT_DAYS)).isoformat()
+    wellness, recent_count, prs = await asyncio.gather(
+        db.wellness.find(
+            {"athlete_id": athlete_id, "date": {"$gte": days[0], "$lte": days[-1]}},
+            {"_id": 0, "date": 1, "fatigue": 1, "soreness": 1, "muscle_soreness": 1}
+        ).to_list(ANALYTICS_CURVE_DAYS),
+        db.workouts.count_documents({"athlete_id": athlete_id, "completed": True, "date": {"$gte": since_count}}),
+        top_personal_records(athlete_id),
+    )
+    by_day = {w['date']: w for w in wellness}
+    return {
+        "fatigue_data": [by_day.get(day, {}).get('fatigue') or 0 for day in days],
+        "soreness_data": [(by_day.get(day, {}).get('soreness') or by_day.get(day, {}).get('muscle_soreness') or 0) for day in days],
+        "recent_workouts_count": recent_count,
+        "recent_prs": prs,
+    }
+
+async def run_analyze_athlete(athlete_id: str, refresh: bool = False) -> dict:
+    """
+    Analítica IA sin payload del cliente. Se memoiza por atleta y día: si las entradas no han
+    cambiado desde la última llamada de hoy, se devuelve el análisis guardado sin llamar a la IA.
+    """
+    athlete = await get_cached_user(athlete_id)
+    if not athlete: raise HTTPException(status_code=404, detail="Atleta no encontrado")
+
+    start = time.perf_counter()
+    inputs = await collect_analytics_inputs(athlete_id)
+    input_hash = hashlib.sha256(json.dumps(inputs, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+    memo_id = f"{athlete_id}:{datetime.now(timezone.utc).date().isoformat()}"
+    if not refresh:
+        memo = await db.brain_analytics_memo.find_one({"_id": memo_id, "input_hash": input_hash})
+        if memo:
+            ANALYTICS_MEMO_STATS["hits"] += 1
+            return {**memo['response'], "inputs": inputs, "cached": True}
+    ANALYTICS_MEMO_STATS["misses"] += 1
+
+    request = AnalyticsAnalyzeRequest(athlete_id=athlete_id, athlete_name=athlete.get('name', 'Atleta'), **inputs)
+    prompt = await build_analytics_prompt(request)
+    BRAIN_LATENCY["prompt"].add(time.perf_counter() - start)
+    start = time.perf_counter()
+    raw_text = await generate_with_fallback(prompt, request_class="batch", response_schema=RESPONSE_SCHEMAS["analytics"])
+    BRAIN_LATENCY["model"].add(time.perf_counter() - start)
+    result = parse_ai_response(raw_text, AnalyticsAIResponse)
+
+    await db.brain_analytics_memo.replace_one(
+        {"_id": memo_id},
+        {"_id": memo_id, "input_hash": input_hash, "response": result, "created_at": datetime.now(timezone.utc)},
+        upsert=True
+    )
+    return {**result, "inputs": inputs, "cached": False}
+
+@api_router.post("/brain/analyze-analytics/{athlete_id}")
+async def analyze_athlete_api(athlete_id: str, response: Response, job: bool = Query(False), refresh: bool = Query(False), user=Depends(get_current_user)):
+    if user['role'] == 'athlete' and athlete_id != user['id']:
+        raise HTTPException(status_code=403, detail="No autorizado")
+    if user['role'] == 'trainer':
+        athlete = await get_cached_user(athlete_id)
+        if not athlete or athlete.get('trainer_id') != user['id']:
+            raise HTTPException(status_code=404, detail="Atleta no encontrado")
+    if not LLM_PROVIDER.is_configured():
+        raise HTTPException(status_code=500, detail="API de Gemini no configurada.")
+    if job:
+        response.status_code = 202
+        return await enqueue_brain_job("analyze-athlete", {"athlete_id": athlete_id, "refresh": refresh}, user)
+
+    try:
+        return await run_analyze_athlete(athlete_id, refresh=refresh)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en analíticas IA: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error conectando con la IA: {str(e)}")
+
+# --- GENERACIÓN DE MICROCICLOS COMPLETOS ---
+MAX_MICROCYCLE_DAYS = 14
+
+def _parse_day(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Fecha inválida: {value}")
+
+async def resolve_microcycle_days(data: MicrocycleGenerateRequest):
+    """Devuelve (fechas a planificar, microciclo o None)."""
+    micro = None
+    if data.microciclo_id:
+        micro = await db.microciclos.find_one({"id": data.microciclo_id}, {"_id": 0})
+        if not micro: raise HTTPException(status_code=404, detail="Microciclo no encontrado")
+        macro = await db.macrociclos.find_one({"id": micro['macrociclo_id'], "athlete_id": data.athlete_id}, {"_id": 0, "id": 1})
+        if not macro: raise HTTPException(status_code=400, detail="El microciclo no pertenece a este atleta")
+        start, end = _parse_day(micro['fecha_inicio']), _parse_day(micro['fecha_fin'])
+    elif data.fecha_inicio and data.fecha_fin:
+        start, end = _parse_day(data.fecha_inicio), _parse_day(data.fecha_fin)
+    else:
+        raise HTTPException(status_code=400, detail="Indica microciclo_id o fecha_inicio y fecha_fin")
+
+    if end < start:
+        raise HTTPException(status_code=400, detail="Rango de fechas inválido")
+    all_days = [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((end - start).days + 1)]
+    days = sorted(set(data.training_days)) if data.training_days else all_days
+    if any(day not in all_days for day in days):
+        raise HTTPException(status_code=400, detail="training_days debe estar dentro del rango del microciclo")
+    if len(days) > MAX_MICROCYCLE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_MICROCYCLE_DAYS} sesiones por generación")
+    return days, micro
+
+def build_microcycle_prompt(context: AthleteContext, days: List[str], micro: Optional[dict], data: MicrocycleGenerateRequest, trainer_id: str) -> str:
+    dias_semana = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo"]
+    calendario = "\n".join(f"        Día {i}: {day} ({dias_semana[_parse_day(day).weekday()]})" for i, day in enumerate(days, start=1))
+    fase = f"{micro.get('nombre')} (Tipo: {micro.get('tipo', 'CARGA')})" if micro else "Sin microciclo asignado"
+    return f"""
+        Eres un preparador físico de élite y experto en alto rendimiento.
+        Estás planificando un microciclo completo para {context.name}.
+
+        CONTEXTO BIOMÉTRICO Y DEPORTIVO DE {context.name.upper()}:
+        {render_athlete_context(context)}
+
+        FASE DEL MICROCICLO: {fase}
+        ESTADO ACTUAL: Fatiga {data.athleteContext.get('fatigue', '-')}/5, Dolor/Agujetas {data.athleteContext.get('soreness', '-')}/5.
+        RESTRICCIONES DEL ENTRENADOR: {data.constraints or 'Ninguna'}
+        {render_few_shot_examples(trainer_id, " ".join([data.constraints or '', context.sport or '', fase]))}
+        DÍAS DISPONIBLES ({len(days)}):
+{calendario}
+
+        Reparte la carga de forma coherente entre los días (puedes dejar días de descanso: simplemente no los incluyas).
+        RESPONDE ÚNICAMENTE CON JSON PURO USANDO ESTA ESTRUCTURA EXACTA. "day" es el número de día de la lista anterior.
+        Los bloques de "exercises" siguen el formato TRADICIONAL o HIIT habitual.
+
+        {{
+            "coach_analysis": "Cómo has distribuido la carga de la semana y por qué.",
+            "sessions": [
+                {{
+                    "day": 1,
+                    "title": "Nombre de la sesión",
+                    "notes": "Indicaciones generales (calentamiento, enfoque).",
+                    "exercises": [
+                        {{"is_hiit_block": false, "name": "Sentadilla Búlgara", "sets": "3", "reps": "10-12", "duration": "", "rest": "90s", "rest_exercise": "60s", "exercise_notes": "Enfoque en excéntrica."}},
+                        {{"is_hiit_block": true, "name": "Metcon Finisher", "sets": "4", "rest_exercise": "15s", "rest_block": "60s", "rest_between_blocks": "2m",
+                          "hiit_exercises": [{{"name": "Burpees", "sets": "1", "duration_reps": "15", "duration": "45s", "exercise_notes": "Ritmo constante"}}]}}
+                    ]
+                }}
+            ]
+        }}
+        """
+
+def validate_microcycle_sessions(result, days: List[str], data: MicrocycleGenerateRequest) -> List[WorkoutCreate]:
+    """Convierte la respuesta de la IA en WorkoutCreate; cualquier sesión mal formada invalida el lote."""
+    sessions = result.get('sessions') if isinstance(result, dict) else None
+    if not isinstance(sessions, list) or not sessions:
+        raise HTTPException(status_code=502, detail="La IA no devolvió sesiones para el microciclo.")
+
+    workouts, used_days = [], set()
+    for session in sessions:
+        if not isinstance(session, dict):
+            raise HTTPException(status_code=502, detail="La IA devolvió una sesión mal formada.")
+        day = session.get('day')
+        if isinstance(day, str) and day.strip().isdigit():
+            day = int(day)  # "1" también vale
+        if not isinstance(day, int) or isinstance(day, bool):
+            raise HTTPException(status_code=502, detail="La IA devolvió una sesión sin día válido.")
+        if not 1 <= day <= len(days) or day in used_days:
+            raise HTTPException(status_code=502, detail=f"La IA devolvió un día fuera de rango o repetido: {day}")
+        exercises = session.get('exercises')
+        if not isinstance(exercises, list) or not exercises or not all(isinstance(ex, dict) and ex.get('name') for ex in exercises):
+            raise HTTPException(status_code=502, detail=f"La sesión del día {day} no tiene ejercicios válidos.")
+        used_days.add(day)
+        workouts.append(WorkoutCreate(
+            title=str(session.get('title') or f"Sesión {day}"),
+            date=days[day - 1],
+            exercises=exercises,
+            notes=str(session.get('notes') or ""),
+            athlete_id=data.athlete_id,
+            microciclo_id=data.microciclo_id,
+            is_ai=True,
+        ))
+    return sorted(workouts, key=lambda w: w.date)
+
+@api_router.post("/brain/generate-microcycle")
+async def generate_microcycle_api(data: MicrocycleGenerateRequest, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
+    """Planifica todas las sesiones de un microciclo con una sola llamada a la IA y las guarda con un insert_many."""
+    if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
+    if not LLM_PROVIDER.is_configured():
+        raise HTTPException(status_code=500, detail="API de Gemini no configurada.")
+
+    try:
+        start = time.perf_counter()
+        context = await build_athlete_context(data.athlete_id)
+        # Mismo 404 que para un atleta inexistente: no se revela si el atleta existe en otra plantilla
+        if not context.found or context.trainer_id != user['id']:
+            raise HTTPException(status_code=404, detail="Atleta no encontrado")
+        days, micro = await resolve_microcycle_days(data)
+        system_prompt = build_microcycle_prompt(context, days, micro, data, user['id'])
+        BRAIN_LATENCY["prompt"].add(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        raw_text = await generate_with_fallback("Genera el microciclo.", system_instruction=system_prompt, request_class="batch",
+                                                response_schema=RESPONSE_SCHEMAS["microcycle"])
+        BRAIN_LATENCY["model"].add(time.perf_counter() - start)
+        # Una semana cortada no se guarda a medias: la última sesión podría llevar valores truncados
+        result = parse_ai_response(raw_text, MicrocycleAIResponse, allow_truncated=False)
+        workouts = validate_microcycle_sessions(result, days, data)
+
+        if data.dry_run:
+            saved = [w.dict() for w in workouts]
+        else:
+            saved = await insert_workouts_bulk(workouts, user, background_tasks)
+            for workout in saved:
+                workout.pop('_id', None)
+        return {
+            "coach_analysis": result.get('coach_analysis', ''),
+            "dry_run": bool(data.dry_run),
+            "inserted": 0 if data.dry_run else len(saved),
+            "workouts": saved,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error generando microciclo IA: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error conectando con la IA: {str(e)}")
+
+# --- COLA DE TRABAJOS IA ---
+# Con ?job=true los endpoints del cerebro devuelven un job_id al momento y la generación la hace un
+# pool de workers que reclama trabajos de Mongo con un lease. Si un proceso muere, el lease caduca
+# y otro worker lo retoma.
+BRAIN_JOB_HANDLERS = {
+    "generate-workout": lambda payload, job: run_generate_workout(GeminiChatRequest(**payload), job.get('trainer_id'), request_class="batch"),
+    "analyze-analytics": lambda payload, job: run_analyze_analytics(AnalyticsAnalyzeRequest(**payload)),
+    "analyze-athlete": lambda payload, job: run_analyze_athlete(payload['athlete_id'], refresh=payload.get('refresh', False)),
+}
+BRAIN_JOB_ENQUEUE_ATTEMPTS = 3
+BRAIN_JOB_STATS = {"enqueued": 0, "deduplicated": 0, "completed": 0, "failed": 0, "reclaimed": 0, "running": 0}
+BRAIN_JOB_WAKEUP = asyncio.Event()
+
+def brain_job_view(job: dict) -> dict:
+    return {
+        "job_id": job['id'], "kind": job['kind'], "status": job['status'],
+        "result": job.get('result'), "error": job.get('error'),
+        "created_at": job['created_at'], "updated_at": job.get('updated_at'),
+    }
+
+async def enqueue_brain_job(kind: str, payload: dict, user: dict) -> dict:
+    """Crea el trabajo o, si ya hay uno activo con la misma petición, devuelve ese."""
+    request_hash = hashlib.sha256(json.dumps([kind, user['id'], payload], sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+    now = datetime.now(timezone.utc).isoformat()
+    job = {
+        "id": str(uuid.uuid4()), "kind": kind, "owner_id": user['id'], "trainer_id": resolve_trainer_id(user), "request_hash": request_hash,
+        "payload": payload, "status": "queued", "active": True, "attempts": 0,
+        "created_at": now, "updated_at": now,
+    }
+    # Buscar-o-insertar acotado: el activo puede terminar (o crearse otro) entre el insert y la lectura
+    for _ in range(BRAIN_JOB_ENQUEUE_ATTEMPTS):
+        try:
+            await db.brain_jobs.insert_one(dict(job))  # copia: insert_one añade _id al dict
+            BRAIN_JOB_STATS["enqueued"] += 1
+            BRAIN_JOB_WAKEUP.set()
+            return {"job_id": job['id'], "status": job['status']}
+        except DuplicateKeyError:
+            existing = await db.brain_jobs.find_one({"request_hash": request_hash, "active": True}, {"_id": 0})
+            if existing:
+                BRAIN_JOB_STATS["deduplicated"] += 1
+                return {"job_id": existing['id'], "status": existing['status']}
+    raise HTTPException(status_code=503, detail="No se pudo encolar el trabajo. Inténtalo de nuevo.")
+
+async def claim_brain_job() -> Optional[dict]:
+    now = datetime.now(timezone.utc)
+    lease = {"$set": {"status": "running", "worker": WORKER_ID, "lease_until": now + timedelta(seconds=BRAIN_JOB_LEASE_SECONDS), "updated_at": now.isoformat()}, "$inc": {"attempts": 1}}
+    job = await db.brain_jobs.find_one_and_update(
+        {"status": "queued"}, lease, sort=[("created_at", ASCENDING)], projection={"_id": 0}, return_document=ReturnDocument.AFTER
+    )
+    if job:
+        return job
+    # Trabajos cuyo worker murió o se colgó
+    job = await db.brain_jobs.find_one_and_update(
+        {"status": "running", "lease_until": {"$lt": now}}, lease, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+    )
+    if job:
+        BRAIN_JOB_STATS["reclaimed"] += 1
+        logger.warning(f"Trabajo IA {job['id']} retomado tras caducar su lease (intento {job['attempts']}).")
+    return job
+
+async def finish_brain_job(job: dict, status: str, **fields):
+    now = datetime.now(timezone.utc)
+    # Solo si el lease sigue siendo nuestro: si otro worker lo retomó, su resultado manda
+    await db.brain_jobs.update_one(
+        {"id": job['id'], "worker": WORKER_ID, "attempts": job['attempts']},
+        {"$set": {"status": status, "active": False, "finished_at": now, "updated_at": now.isoformat(), **fields}, "$unset": {"lease_until": "", "payload": ""}}
+    )
+
+async def process_brain_job(job: dict):
+    if job['attempts'] > BRAIN_JOB_MAX_ATTEMPTS:
+        await finish_brain_job(job, "error", error={"status": 500, "detail": "Reintentos agotados."})
+        BRAIN_JOB_STATS["failed"] += 1
+        return
+    try:
+        result = await BRAIN_JOB_HANDLERS[job['kind']](job['payload'], job)
+        await finish_brain_job(job, "done", result=result)
+        BRAIN_JOB_STATS["completed"] += 1
+    except HTTPException as e:
+        await finish_brain_job(job, "error", error={"status": e.status_code, "detail": e.detail})
+        BRAIN_JOB_STATS["failed"] += 1
+    except Exception as e:
+        logger.error(f"Error en trabajo IA {job['id']}: {str(e)}")
+        await finish_brain_job(job, "error", error={"status": 500, "detail": f"Error conectando con la IA: {str(e)}"})
+        BRAIN_JOB_STATS["failed"] += 1
+
+async def brain_job_worker():
+    while True:
+        try:
+            job = await claim_brain_job()
+            if not job:
+                BRAIN_JOB_WAKEUP.clear()
+                try:
+                    await asyncio.wait_for(BRAIN_JOB_WAKEUP.wait(), timeout=BRAIN_JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            BRAIN_JOB_STATS["running"] += 1
+            try:
+                await process_brain_job(job)
+            finally:
+                BRAIN_JOB_STATS["running"] -= 1
+        except Exception as e:
+            logger.error(f"Error en el worker de trabajos IA: {str(e)}")
+            await asyncio.sleep(BRAIN_JOB_POLL_SECONDS)
+
+@app.on_event("startup")
+async def start_brain_job_workers():
+    for _ in range(BRAIN_JOB_WORKERS):
+        asyncio.create_task(brain_job_worker())
+
+@api_router.get("/brain/jobs/{job_id}")
+async def get_brain_job(job_id: str, user=Depends(get_current_user)):
+    job = await db.brain_jobs.find_one({"id": job_id, "owner_id": user['id']}, {"_id": 0, "payload": 0})
+    if not job: raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return brain_job_view(job)
+
+# --- ESTADÍSTICAS MATERIALIZADAS POR ATLETA ---
+# athlete_stats (_id = athlete_id) resume lo que pinta cada tarjeta de atleta. Las escrituras de workouts,
+# wellness y perfil lo ajustan con $inc/$set (upsert) y suben el contador `writes`. Un documento sin
+# rebuilt_at solo tiene deltas: la primera lectura lo calcula entero y lo guarda únicamente si `writes`
+# no cambió mientras calculaba; si cambió, vuelve a calcular. `python server.py rebuild-athlete-stats`
+# corrige cualquier deriva.
+EMPTY_WELLNESS = {"fatigue": 0, "stress": 0, "sleep_quality": 0, "soreness": 0, "notes": "", "cycle_phase": ""}
+
+async def compute_athlete_stats(athlete_id: str):
+    """Devuelve (stats, es_atleta): solo se guarda athlete_stats de usuarios atleta que existen."""
+    target_user, total, completed, latest_well, last_completed, last_legacy = await asyncio.gather(
+        db.users.find_one({"id": athlete_id}, {"_id": 0, "role": 1, "trainer_id": 1, "is_injured": 1, "injury_notes": 1, "equipment": 1}),
+        db.workouts.count_documents({"athlete_id": athlete_id}),
+        db.workouts.count_documents({"athlete_id": athlete_id, "completed": True}),
+        db.wellness.find_one({"athlete_id": athlete_id}, {"_id": 0}, sort=[("date", -1), ("updated_at", -1)]),
+        db.workouts.find_one({"athlete_id": athlete_id, "completed": True, "completed_at": {"$exists": True}}, {"_id": 0, "completed_at": 1}, sort=[("completed_at", -1)]),
+        # Sesiones completadas antes de existir completed_at: cuenta su fecha programada
+        db.workouts.find_one({"athlete_id": athlete_id, "completed": True, "completed_at": {"$exists": False}}, {"_id": 0, "date": 1}, sort=[("date", -1)]),
+    )
+    last_completed_at = max([v for v in ((last_completed or {}).get('completed_at'), (last_legacy or {}).get('date')) if v], default=None)
+    stats = build_athlete_stats(athlete_id, target_user or {}, total, completed, latest_well, last_completed_at)
+    return stats, bool(target_user) and target_user.get('role') == 'athlete'
+
+def build_athlete_stats(athlete_id: str, target_user: dict, total: int, completed: int, latest_well: Optional[dict], last_completed_at: Optional[str]) -> dict:
+    # last_activity_at = último instante real de actividad: updated_at del wellness o completed_at de una sesión
+    # (su date si se completó antes de guardarse completed_at)
+    activity = [v for v in ((latest_well or {}).get('updated_at'), last_completed_at) if v]
+    stats = {
+        "_id": athlete_id,
+        "trainer_id": target_user.get('trainer_id'),
+        "total_workouts": total,
+        "completed_workouts": completed,
+        "latest_wellness": latest_well,
+        "latest_wellness_date": (latest_well or {}).get('date'),
+        "is_injured": target_user.get("is_injured", False),
+        "injury_notes": target_user.get("injury_notes", ""),
+        "equipment": target_user.get("equipment", ""),
+        "rebuilt_at": datetime.now(timezone.utc).isoformat(),
+    }
+    if activity:
+        stats["last_activity_at"] = max(activity)  # ausente mientras no haya actividad, para que $max lo fije
+    return stats
+
+ATHLETE_STATS_USER_FIELDS = {"_id": 0, "id": 1, "trainer_id": 1, "is_injured": 1, "injury_notes": 1, "equipment": 1}
+
+async def compute_athlete_stats_batch(athletes: List[dict]) -> Dict[str, dict]:
+    """Igual que compute_athlete_stats pero para muchos atletas: dos agregaciones $in en total."""
+    ids = [a['id'] for a in athletes]
+    counts, wellness = {}, {}
+    workouts_pipeline = [
+        {"$match": {"athlete_id": {"$in": ids}}},
+        {"$group": {"_id": "$athlete_id", "total": {"$sum": 1}, "completed": {"$sum": {"$cond": [{"$eq": ["$completed", True]}, 1, 0]}},
+                    "last_completed": {"$max": {"$cond": [{"$eq": ["$completed", True]}, {"$ifNull": ["$completed_at", "$date"]}, None]}}}},
+    ]
+    wellness_pipeline = [
+        {"$match": {"athlete_id": {"$in": ids}}},
+        {"$sort": {"athlete_id": 1, "date": -1, "updated_at": -1}},
+        {"$group": {"_id": "$athlete_id", "doc": {"$first": "$$ROOT"}}},
+    ]
+    workout_rows, wellness_rows = await asyncio.gather(
+        db.workouts.aggregate(workouts_pipeline).to_list(None),
+        db.wellness.aggregate(wellness_pipeline).to_list(None),
+    )
+    for row in workout_rows:
+        counts[row['_id']] = row
+    for row in wellness_rows:
+        row['doc'].pop('_id', None)
+        wellness[row['_id']] = row['doc']
+    return {
+        a['id']: build_athlete_stats(a['id'], a, counts.get(a['id'], {}).get('total', 0), counts.get(a['id'], {}).get('completed', 0),
+                                     wellness.get(a['id']), counts.get(a['id'], {}).get('last_completed'))
+        for a in athletes
+    }
+
+ATHLETE_STATS_BUILD_ATTEMPTS = 3
+
+def athlete_stats_store_op(stats: dict, seen: Optional[dict]):
+    """Guarda un cálculo completo solo si nadie escribió en athlete_stats desde que se leyó `seen`."""
+    if seen is None:
+        return InsertOne(dict(stats))  # si un writer lo creó entretanto, DuplicateKey y se recalcula
+    fields = {k: v for k, v in stats.items() if k != "_id"}
+    return UpdateOne({"_id": stats["_id"], "rebuilt_at": {"$exists": False}, "writes": seen.get("writes")}, {"$set": fields})
+
+async def store_athlete_stats(ops: list) -> int:
+    """Devuelve cuántos cálculos se guardaron; los que perdieron la carrera se reintentan al leerlos."""
+    if not ops:
+        return 0
+    try:
+        result = await db.athlete_stats.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        return e.details.get("nInserted", 0) + e.details.get("nMatched", 0)
+    return result.inserted_count + result.matched_count
+
+async def get_athlete_stats(athlete_id: str) -> dict:
+    for _ in range(ATHLETE_STATS_BUILD_ATTEMPTS):
+        seen = await db.athlete_stats.find_one({"_id": athlete_id})
+        if seen and seen.get('rebuilt_at'):
+            return seen
+        stats, is_athlete = await compute_athlete_stats(athlete_id)
+        if not is_athlete:
+            return stats  # el propio entrenador o un id inexistente: se calcula pero no se guarda
+        if await store_athlete_stats([athlete_stats_store_op(stats, seen)]):
+            return stats
+    # Sigue habiendo escrituras en paralelo: el cálculo vale para esta respuesta y la siguiente lectura lo guarda
+    return stats
+
+def athlete_stats_view(stats: dict) -> dict:
+    total, completed = max(0, stats.get('total_workouts', 0)), max(0, stats.get('completed_workouts', 0))
+    return {
+        "total_workouts": total, "completed_workouts": completed,
+        "latest_wellness": stats.get('latest_wellness') or dict(EMPTY_WELLNESS),
+        "completion_rate": round((completed / total * 100) if total > 0 else 0, 1),
+        "is_injured": stats.get('is_injured') or False,
+        "injury_notes": stats.get('injury_notes') or "",
+        "equipment": stats.get('equipment') or "",
+        "last_activity_at": stats.get('last_activity_at'),
+    }
+
+def workout_stats_op(athlete_id: Optional[str], total: int = 0, completed: int = 0, activity_at: Optional[str] = None) -> Optional[UpdateOne]:
+    if not athlete_id:
+        return None
+    update = {"$inc": {"total_workouts": total, "completed_workouts": completed, "writes": 1}}
+    if activity_at:
+        update["$max"] = {"last_activity_at": activity_at}
+    return UpdateOne({"_id": athlete_id}, update, upsert=True)
+
+async def apply_athlete_stats(ops: List[Optional[UpdateOne]]):
+    ops = [op for op in ops if op is not None]
+    if ops:
+        await db.athlete_stats.bulk_write(ops, ordered=False)
+
 # --- RUTAS DE WELLNESS ---
 @api_router.get("/wellness/history/{athlete_id}")
 async def get_wellness_history(athlete_id: str, user=Depends(get_current_user)):
@@ -614,12 +2883,18 @@ async def create_wellness(data: WellnessCreate, background_tasks: BackgroundTask
         "updated_at": datetime.now(timezone.utc).isoformat()
     }
     
-    existing = await db.wellness.find_one({"athlete_id": target_athlete_id, "date": target_date})
-    if existing:
-        await db.wellness.update_one({"_id": existing["_id"]}, {"$set": wellness_data})
-    else:
-        wellness_data.update({"id": str(uuid.uuid4()), "athlete_id": target_athlete_id, "date": target_date, "created_at": wellness_data["updated_at"]})
-        await db.wellness.insert_one(wellness_data)
+    # Upsert atómico sobre el índice único (athlete_id, date)
+    wellness_doc = await db.wellness.find_one_and_update(
+        {"athlete_id": target_athlete_id, "date": target_date},
+        {"$set": wellness_data, "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": wellness_data["updated_at"]}},
+        projection={"_id": 0}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    # Solo sustituye la foto si es del mismo día o posterior a la guardada
+    await db.athlete_stats.update_one({"_id": target_athlete_id}, {"$inc": {"writes": 1}}, upsert=True)
+    await db.athlete_stats.update_one(
+        {"_id": target_athlete_id, "$or": [{"latest_wellness_date": {"$lte": target_date}}, {"latest_wellness_date": None}]},
+        {"$set": {"latest_wellness": wellness_doc, "latest_wellness_date": target_date}, "$max": {"last_activity_at": wellness_data["updated_at"]}}
+    )
 
     # 🤖 AGENTE FISIO: Intervención Automática
     # if data.fatigue >= 4 or data.soreness >= 4:
@@ -642,7 +2917,7 @@ async def create_wellness(data: WellnessCreate, background_tasks: BackgroundTask
 
    # Notificaciones por Email a Andre/Entrenador
     if user.get('role') == 'athlete' and user.get('trainer_id'):
-        trainer = await db.users.find_one({"id": user['trainer_id']})
+        trainer = await get_cached_user(user['trainer_id'])
         # Verificamos si tiene los emails activados (por defecto asumimos que Sí)
         if trainer and trainer.get('email_notifications', True) is not False:
             athlete_name = user.get('name', 'Un deportista')
@@ -672,18 +2947,137 @@ async def create_wellness(data: WellnessCreate, background_tasks: BackgroundTask
 @api_router.get("/analytics/summary")
 async def analytics_summary(athlete_id: Optional[str] = None, user=Depends(get_current_user)):
     target_id = athlete_id if (user['role'] == 'trainer' and athlete_id) else user['id']
-    target_user = await db.users.find_one({"id": target_id}, {"_id": 0})
-    total = await db.workouts.count_documents({"athlete_id": target_id})
-    completed = await db.workouts.count_documents({"athlete_id": target_id, "completed": True})
-    latest_well = await db.wellness.find_one({"athlete_id": target_id}, {"_id": 0}, sort=[("date", -1), ("updated_at", -1)])
-    return {
-        "total_workouts": total, "completed_workouts": completed,
-        "latest_wellness": latest_well or {"fatigue": 0, "stress": 0, "sleep_quality": 0, "soreness": 0, "notes": "", "cycle_phase": ""},
-        "completion_rate": round((completed / total * 100) if total > 0 else 0, 1),
-        "is_injured": target_user.get("is_injured", False) if target_user else False,
-        "injury_notes": target_user.get("injury_notes", "") if target_user else "",
-        "equipment": target_user.get("equipment", "") if target_user else ""
-    }
+    return athlete_stats_view(await get_athlete_stats(target_id))
+
+# --- PANEL DEL ENTRENADOR ---
+# Toda la plantilla en una petición: roster + athlete_stats con $in + un $group de las sesiones del día.
+# Los atletas sin athlete_stats completo se calculan en bloque y se guardan, sin consultas por atleta.
+# Cada criterio recibe la vista y el athlete_stats guardado: el wellness se mira en este último,
+# porque la vista rellena con EMPTY_WELLNESS (ceros) a quien nunca lo ha registrado
+DASHBOARD_SORTS = {
+    "name": lambda a, s: (a['name'] or '').lower(),
+    "fatigue": lambda a, s: (s.get('latest_wellness') or {}).get('fatigue'),
+    "soreness": lambda a, s: (s.get('latest_wellness') or {}).get('soreness'),
+    "stress": lambda a, s: (s.get('latest_wellness') or {}).get('stress'),
+    "completion_rate": lambda a, s: a['completion_rate'],
+    "last_activity": lambda a, s: a['last_activity_at'],
+}
+
+@api_router.get("/trainer/dashboard")
+async def trainer_dashboard(
+    sort: str = "name",
+    order: str = "asc",
+    injured: Optional[bool] = None,
+    has_session_today: Optional[bool] = None,
+    min_fatigue: Optional[int] = None,
+    date: Optional[str] = None,
+    user=Depends(get_current_user)
+):
+    if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
+    if sort not in DASHBOARD_SORTS or order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"Orden no válido. Usa sort={'|'.join(DASHBOARD_SORTS)} y order=asc|desc")
+    today = date or datetime.now(timezone.utc).isoformat().split('T')[0]
+
+    roster = await db.users.find(
+        {"trainer_id": user['id'], "role": "athlete"},
+        {"_id": 0, "id": 1, "name": 1, "sport": 1, "sport_icon": 1, "gender": 1, "trainer_id": 1, "is_injured": 1, "injury_notes": 1, "equipment": 1}
+    ).to_list(None)
+    ids = [a['id'] for a in roster]
+    stored, sessions = await asyncio.gather(
+        db.athlete_stats.find({"_id": {"$in": ids}}).to_list(None),
+        db.workouts.aggregate([
+            {"$match": {"athlete_id": {"$in": ids}, "date": today}},
+            {"$group": {"_id": "$athlete_id", "sessions": {"$push": {"id": "$id", "title": "$title", "completed": "$completed"}}}},
+        ]).to_list(None),
+    )
+    seen = {s['_id']: s for s in stored}
+    stats = {i: s for i, s in seen.items() if s.get('rebuilt_at')}
+    missing = [a for a in roster if a['id'] not in stats]
+    if missing:
+        computed = await compute_athlete_stats_batch(missing)
+        await store_athlete_stats([athlete_stats_store_op(st, seen.get(i)) for i, st in computed.items()])
+        stats.update(computed)
+    sessions = {row['_id']: row['sessions'] for row in sessions}
+
+    athletes = []
+    for a in roster:
+        view = athlete_stats_view(stats[a['id']])
+        view.update({
+            "id": a['id'], "name": a.get('name'), "sport": a.get('sport'), "sport_icon": a.get('sport_icon'), "gender": a.get('gender'),
+            "today_sessions": [{**w, "completed": bool(w.get('completed'))} for w in sessions.get(a['id'], [])],
+        })
+        if injured is not None and view['is_injured'] != injured:
+            continue
+        if has_session_today is not None and bool(view['today_sessions']) != has_session_today:
+            continue
+        if min_fatigue is not None and (view['latest_wellness'].get('fatigue') or 0) < min_fatigue:
+            continue
+        athletes.append((view, stats[a['id']]))
+
+    # Los atletas sin dato para el criterio van siempre al final, sea cual sea el orden
+    key = lambda pair: DASHBOARD_SORTS[sort](*pair)
+    with_value = [p for p in athletes if key(p) is not None]
+    without_value = [p for p in athletes if key(p) is None]
+    with_value.sort(key=key, reverse=(order == "desc"))
+    return {"date": today, "count": len(athletes), "total_athletes": len(roster), "athletes": [view for view, _ in with_value + without_value]}
+
+# --- VERIFICACIÓN DE TOKENS DE GOOGLE ---
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+class GoogleTokenVerifier:
+    """
+    Verifica ID tokens de Google en local. Las claves públicas se descargan con una sesión HTTP
+    reutilizada y se cachean hasta que caduca su Cache-Control. Con certs_file (modo test) se usa
+    un juego de claves local y no hay red.
+    """
+
+    def __init__(self, certs_url: str = GOOGLE_CERTS_URL, certs_file: Optional[str] = None):
+        self.certs_url = certs_url
+        self.certs_file = certs_file
+        self._session = requests.Session()
+        self._certs = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self.stats = {"cert_fetches": 0, "verifications": 0, "failures": 0}
+
+    def _fetch_certs(self) -> tuple:
+        if self.certs_file:
+            with open(self.certs_file) as f:
+                return json.load(f), float('inf')
+        response = self._session.get(self.certs_url, timeout=10)
+        response.raise_for_status()
+        max_age = 300
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        if match:
+            max_age = int(match.group(1))
+        return response.json(), time.time() + max_age
+
+    async def get_certs(self, force_refresh: bool = False) -> dict:
+        if force_refresh or self._certs is None or time.time() >= self._expires_at:
+            async with self._lock:
+                # Otra corrutina puede haberlas refrescado mientras esperábamos el lock
+                if force_refresh or self._certs is None or time.time() >= self._expires_at:
+                    self._certs, self._expires_at = await asyncio.to_thread(self._fetch_certs)
+                    self.stats["cert_fetches"] += 1
+        return self._certs
+
+    async def verify(self, token: str) -> dict:
+        try:
+            certs = await self.get_certs()
+            # Google puede rotar claves antes de que caduque la caché: un kid desconocido fuerza recarga
+            if jwt.get_unverified_header(token).get('kid') not in certs:
+                certs = await self.get_certs(force_refresh=True)
+            id_info = await asyncio.to_thread(google_jwt.decode, token, certs=certs, clock_skew_in_seconds=10)
+            if id_info.get('iss') not in GOOGLE_ISSUERS:
+                raise ValueError(f"Emisor de token no válido: {id_info.get('iss')}")
+        except Exception:
+            self.stats["failures"] += 1
+            raise
+        self.stats["verifications"] += 1
+        return id_info
+
+GOOGLE_VERIFIER = GoogleTokenVerifier(certs_file=os.environ.get('GOOGLE_CERTS_FILE'))
 
 # --- RUTAS DE USUARIOS Y AUTENTICACIÓN ---
 @api_router.post("/auth/register")
@@ -691,24 +3085,21 @@ async def register(data: UserRegister):
     existing = await db.users.find_one({"email": data.email})
     if existing: raise HTTPException(status_code=400, detail="Email ya registrado")
     user_id = str(uuid.uuid4())
-    user = {"id": user_id, "email": data.email, "password": hash_password(data.password), "name": data.name, "role": "trainer", "created_at": datetime.now(timezone.utc).isoformat()}
+    user = {"id": user_id, "email": data.email, "password": await hash_password_async(data.password), "name": data.name, "role": "trainer", "created_at": datetime.now(timezone.utc).isoformat()}
     await db.users.insert_one(user)
-    return {"token": create_token(user_id, "trainer"), "user": {k: v for k, v in user.items() if k not in ('password', '_id')}}
+    return build_auth_response(user)
 
 @api_router.post("/auth/login")
 async def login(data: UserLogin):
     user = await db.users.find_one({"email": data.email})
-    if not user or not verify_password(data.password, user['password']):
+    if not user or not await verify_password_async(data.password, user['password']):
         raise HTTPException(status_code=401, detail="Email o contraseña incorrectos")
-    return {"token": create_token(user['id'], user['role']), "user": {k: v for k, v in user.items() if k not in ('_id', 'password')}}
+    return build_auth_response(user)
 
 @api_router.post("/auth/google")
 async def google_login(data: GoogleAuth):
     try:
-        import google.auth.transport.requests as google_requests
-        from google.oauth2 import id_token
-        
-        id_info = id_token.verify_oauth2_token(data.token, google_requests.Request(), audience=None)
+        id_info = await GOOGLE_VERIFIER.verify(data.token)
         
         if id_info.get('aud') not in [GOOGLE_CLIENT_ID, GOOGLE_ANDROID_CLIENT_ID, GOOGLE_IOS_CLIENT_ID]:
             raise HTTPException(status_code=401, detail="El token no pertenece a esta aplicación")
@@ -720,22 +3111,50 @@ async def google_login(data: GoogleAuth):
         if not user:
             if data.role == 'athlete': raise HTTPException(status_code=403, detail="Sin invitación activa.")
             user_id = str(uuid.uuid4())
-            user = {"id": user_id, "email": email, "password": hash_password(str(uuid.uuid4())), "name": id_info.get('name', 'Usuario'), "role": data.role, "created_at": datetime.now(timezone.utc).isoformat()}
+            user = {"id": user_id, "email": email, "password": await hash_password_async(str(uuid.uuid4())), "name": id_info.get('name', 'Usuario'), "role": data.role, "created_at": datetime.now(timezone.utc).isoformat()}
             await db.users.insert_one(user)
             
-        return {"token": create_token(user['id'], user['role']), "user": {k: v for k, v in user.items() if k not in ('_id', 'password')}}
+        return build_auth_response(user)
     except Exception as e:
         logger.error(f"Error Google Login: {str(e)}")
         raise HTTPException(status_code=401, detail="Token de Google inválido")
 
+@api_router.post("/auth/refresh")
+async def refresh_session(data: RefreshRequest):
+    payload = decode_token(data.refresh_token)
+    if payload.get('typ') != 'refresh':
+        raise HTTPException(status_code=401, detail="Token inválido o expirado")
+    # Rotación: cada refresh token sirve una sola vez. Reutilizarlo indica robo o doble envío.
+    if not await revoke_refresh_token(payload):
+        raise HTTPException(status_code=401, detail="Sesión revocada")
+    user = await get_cached_user(payload['user_id'])
+    if not user:
+        raise HTTPException(status_code=401, detail="Usuario no encontrado")
+    return build_auth_response(user)
+
+@api_router.post("/auth/logout")
+async def logout(data: RefreshRequest):
+    payload = decode_token(data.refresh_token)
+    if payload.get('typ') == 'refresh':
+        await revoke_refresh_token(payload)
+    return {"status": "success"}
+
 @api_router.get("/auth/me")
 async def get_me(user=Depends(get_current_user)):
+    # Con access tokens stateless solo tenemos los claims: el perfil completo sale de la caché/BD
+    user = await get_cached_user(user['id'])
+    if not user:
+        raise HTTPException(status_code=401, detail="Usuario no encontrado")
     return {"user": {k: v for k, v in user.items() if k not in ('_id', 'password')}}
 
 @api_router.put("/profile")
 async def update_profile(data: ProfileUpdate, user=Depends(get_current_user)):
     update_data = {k: v for k, v in data.dict().items() if v is not None}
     await db.users.update_one({"id": user['id']}, {"$set": update_data})
+    invalidate_user_cache(user['id'])
+    stats_fields = {k: update_data[k] for k in ("is_injured", "injury_notes", "equipment") if k in update_data}
+    if stats_fields:
+        await db.athlete_stats.update_one({"_id": user['id']}, {"$set": stats_fields, "$inc": {"writes": 1}}, upsert=user['role'] == 'athlete')
     return {"status": "success"}
 
 # --- GESTIÓN DE ATLETAS ---
@@ -753,15 +3172,16 @@ async def create_athlete(data: AthleteCreate, user=Depends(get_current_user)):
     if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
     if await db.users.find_one({"email": data.email}): raise HTTPException(status_code=400, detail="Email ya registrado")
     athlete_id = str(uuid.uuid4())
-    await db.users.insert_one({"id": athlete_id, "email": data.email, "password": hash_password(data.password), "name": data.name, "gender": data.gender, "role": "athlete", "sport": data.sport, "phone": data.phone, "trainer_id": user['id'], "created_at": datetime.now(timezone.utc).isoformat()})
+    await db.users.insert_one({"id": athlete_id, "email": data.email, "password": await hash_password_async(data.password), "name": data.name, "gender": data.gender, "role": "athlete", "sport": data.sport, "phone": data.phone, "trainer_id": user['id'], "created_at": datetime.now(timezone.utc).isoformat()})
     return {"status": "success", "id": athlete_id}
 
 @api_router.put("/athletes/{athlete_id}")
 async def update_athlete(athlete_id: str, data: AthleteUpdate, user=Depends(get_current_user)):
     if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
     update_data = {k: v for k, v in data.dict().items() if v is not None}
-    if data.password: update_data["password"] = hash_password(data.password)
+    if data.password: update_data["password"] = await hash_password_async(data.password)
     await db.users.update_one({"id": athlete_id}, {"$set": update_data})
+    invalidate_user_cache(athlete_id)
     return {"status": "success"}
 
 @api_router.patch("/athletes/{athlete_id}/cycles")
@@ -771,15 +3191,18 @@ async def update_athlete_cycles(athlete_id: str, cycles: CycleUpdate, user=Depen
         {"id": athlete_id}, 
         {"$set": {"macro_ciclo": cycles.macro_ciclo, "micro_ciclo": cycles.micro_ciclo}}
     )
+    invalidate_user_cache(athlete_id)
     return {"message": "Ciclos actualizados correctamente", "macro": cycles.macro_ciclo, "micro": cycles.micro_ciclo}
 
 @api_router.delete("/athletes/{athlete_id}")
 async def delete_athlete(athlete_id: str, user=Depends(get_current_user)):
     if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
     await db.users.delete_one({"id": athlete_id})
+    invalidate_user_cache(athlete_id)
     await db.workouts.delete_many({"athlete_id": athlete_id})
     await db.wellness.delete_many({"athlete_id": athlete_id})
     await db.macrociclos.delete_many({"athlete_id": athlete_id})
+    await db.athlete_stats.delete_one({"_id": athlete_id})
     return {"status": "success"}
 
 # --- ENTRENAMIENTOS E INTERCEPTOR ML ---
@@ -787,19 +3210,14 @@ async def delete_athlete(athlete_id: str, user=Depends(get_current_user)):
 async def create_workout(data: WorkoutCreate, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
     workout = data.dict()
     is_ai = workout.pop("is_ai", False)
-    workout.update({"id": str(uuid.uuid4()), "completed": False, "completion_data": None})
+    workout.update({"id": str(uuid.uuid4()), "trainer_id": resolve_trainer_id(user), "completed": False, "completion_data": None})
     
     await db.workouts.insert_one(workout)
+    await apply_athlete_stats([workout_stats_op(data.athlete_id, total=1)])
     
     # 🔥 MACHINE LEARNING
     if not is_ai and user['role'] == 'trainer':
-        await db.brain_memory.insert_one({
-            "id": str(uuid.uuid4()),
-            "title": data.title,
-            "exercises": data.exercises,
-            "notes": data.notes,
-            "learned_at": datetime.now(timezone.utc).isoformat()
-        })
+        await learn_workouts([{"title": data.title, "exercises": data.exercises, "notes": data.notes}], user['id'])
     
     workout.pop('_id', None)
     
@@ -811,92 +3229,140 @@ async def create_workout(data: WorkoutCreate, background_tasks: BackgroundTasks,
             mensaje_html = f"<p>Hola {athlete.get('name', '')},</p><p><b>{trainer_name}</b> acaba de programarte la sesión <b>'{data.title}'</b> para el día {data.date}.</p><p>Abre la app para ver los detalles.</p>"
             background_tasks.add_task(send_email_async, athlete['email'], titulo, mensaje_html)
 
-@api_router.post("/workouts/bulk")
-async def create_workouts_bulk(data: WorkoutBulkCreate, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
+async def insert_workouts_bulk(workouts: List[WorkoutCreate], user: dict, background_tasks: BackgroundTasks) -> List[dict]:
+    """Inserta varias sesiones con un solo insert_many, aprende de las manuales y avisa a cada atleta una vez."""
     new_workouts, athlete_ids, brain_memories = [], set(), []
     
-    for w in data.workouts:
+    for w in workouts:
         workout = w.dict()
         is_ai = workout.pop("is_ai", False)
-        workout.update({"id": str(uuid.uuid4()), "completed": False, "completion_data": None})
+        workout.update({"id": str(uuid.uuid4()), "trainer_id": resolve_trainer_id(user), "completed": False, "completion_data": None})
         new_workouts.append(workout)
         athlete_ids.add(w.athlete_id)
         
         if not is_ai and user['role'] == 'trainer':
-            brain_memories.append({
-                "id": str(uuid.uuid4()),
-                "title": w.title,
-                "exercises": w.exercises,
-                "notes": w.notes,
-                "learned_at": datetime.now(timezone.utc).isoformat()
-            })
+            brain_memories.append({"title": w.title, "exercises": w.exercises, "notes": w.notes})
 
     if new_workouts:
         await db.workouts.insert_many(new_workouts)
+        per_athlete = Counter(w['athlete_id'] for w in new_workouts)
+        await apply_athlete_stats([workout_stats_op(a_id, total=n) for a_id, n in per_athlete.items()])
         if brain_memories:
-            await db.brain_memory.insert_many(brain_memories) 
+            await learn_workouts(brain_memories, user['id'])
             
         if user['role'] == 'trainer':
             trainer_name = user.get('name', 'Tu entrenador')
             for a_id in athlete_ids:
                 athlete = await db.users.find_one({"id": a_id})
                 if athlete and athlete.get('email_notifications', True) is not False:
-                    count = sum(1 for wk in data.workouts if wk.athlete_id == a_id)
+                    count = sum(1 for wk in workouts if wk.athlete_id == a_id)
                     titulo = "📅 Tu calendario ha sido actualizado"
                     mensaje_html = f"<p>Hola {athlete.get('name', '')},</p><p><b>{trainer_name}</b> ha añadido <b>{count} nuevas sesiones</b> a tu planificación.</p><p>Abre la app para revisar las próximas fechas.</p>"
                     background_tasks.add_task(send_email_async, athlete['email'], titulo, mensaje_html)
-                    
+
+    return new_workouts
+
+@api_router.post("/workouts/bulk")
+async def create_workouts_bulk(data: WorkoutBulkCreate, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
+    new_workouts = await insert_workouts_bulk(data.workouts, user, background_tasks)
     return {"status": "success", "inserted": len(new_workouts)}
 
 @api_router.get("/workouts")
-async def list_workouts(athlete_id: Optional[str] = None, date: Optional[str] = None, user=Depends(get_current_user)):
-    query = {'athlete_id': user['id']} if user['role'] == 'athlete' else ({'athlete_id': athlete_id} if athlete_id else {})
+async def list_workouts(
+    athlete_id: Optional[str] = None,
+    date: Optional[str] = None,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    include_exercises: bool = True,
+    user=Depends(get_current_user)
+):
+    query = scoped_athlete_query(user, athlete_id)
     if date: query['date'] = date
-    return await db.workouts.find(query, {"_id": 0}).sort("date", -1).to_list(1000)
+    else: apply_date_range(query, date_from, date_to)
+    projection = {"_id": 0} if include_exercises else {"_id": 0, "exercises": 0}
+    # Con limit o cursor se devuelve una página {items, next_cursor}; sin ellos, la lista de siempre
+    if limit or cursor:
+        return await paginate_by_date(db.workouts, query, projection, limit or 50, cursor)
+    return await db.workouts.find(query, projection).sort([("date", -1), ("id", -1)]).to_list(1000)
 
 @api_router.put("/workouts/{workout_id}")
 async def update_workout(workout_id: str, data: WorkoutUpdate, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
-    existing = await db.workouts.find_one({"id": workout_id})
-    if not existing: raise HTTPException(status_code=404, detail="Sesión no encontrada")
     update_data = data.dict(exclude_unset=True)
     update_data.pop("is_ai", None) 
-    await db.workouts.update_one({"id": workout_id}, {"$set": update_data})
+    update = {"$set": update_data}
+    now_iso = datetime.now(timezone.utc).isoformat()
+    if update_data.get('completed') is True:
+        update["$min"] = {"completed_at": now_iso}  # reenviar completed=True no mueve la fecha de la primera vez
+    elif 'completed' in update_data:
+        update["$unset"] = {"completed_at": ""}
+    # El documento previo sale de la propia actualización: así el ajuste de athlete_stats es exacto
+    existing = await db.workouts.find_one_and_update({"id": workout_id}, update, return_document=ReturnDocument.BEFORE)
+    if not existing: raise HTTPException(status_code=404, detail="Sesión no encontrada")
+
+    was_completed = bool(existing.get('completed'))
+    now_completed = bool(update_data['completed']) if 'completed' in update_data else was_completed
+    # Mismo completed_at que queda guardado en la sesión, el que agrega la reconstrucción
+    completed_at = existing.get('completed_at') if now_completed else None
+    if now_completed and update_data.get('completed') is True:
+        completed_at = min(completed_at or now_iso, now_iso)
+    elif now_completed and not completed_at:
+        completed_at = update_data.get('date') or existing.get('date')  # sesión completada antes de completed_at
+    new_athlete_id = update_data.get('athlete_id') or existing.get('athlete_id')
+    if new_athlete_id != existing.get('athlete_id'):
+        await apply_athlete_stats([
+            workout_stats_op(existing.get('athlete_id'), total=-1, completed=-int(was_completed)),
+            workout_stats_op(new_athlete_id, total=1, completed=int(now_completed), activity_at=completed_at),
+        ])
+    elif now_completed != was_completed:
+        await apply_athlete_stats([workout_stats_op(new_athlete_id, completed=1 if now_completed else -1, activity_at=completed_at)])
     
     if data.completed is True and not existing.get('completed') and user.get('role') == 'athlete' and user.get('trainer_id'):
-        trainer = await db.users.find_one({"id": user['trainer_id']})
+        trainer = await get_cached_user(user['trainer_id'])
         if trainer and trainer.get('web_push_subscription'):
             background_tasks.add_task(send_web_push, trainer['web_push_subscription'], "✅ ¡Entrenamiento superado!", f"{user.get('name')} ha terminado '{existing.get('title')}'.")
     return {"status": "success"}
 
 @api_router.delete("/workouts/{workout_id}")
 async def delete_workout(workout_id: str, user=Depends(get_current_user)):
-    await db.workouts.delete_one({"id": workout_id})
+    deleted = await db.workouts.find_one_and_delete({"id": workout_id}, {"_id": 0, "athlete_id": 1, "completed": 1})
+    if deleted:
+        await apply_athlete_stats([workout_stats_op(deleted.get('athlete_id'), total=-1, completed=-int(bool(deleted.get('completed'))))])
     return {"status": "success"}
 
 # --- PERIODIZACIÓN (Simplified Tree) ---
 @api_router.get("/periodization/tree/{athlete_id}")
 async def get_periodization_tree(athlete_id: str, user=Depends(get_current_user)):
+    def normalize_id(doc):
+        doc["id"] = doc.get("id", str(doc.get("_id")))
+        doc.pop('_id', None)
+        return doc
+
     try:
-        macros = await db.macrociclos.find({"athlete_id": athlete_id}).to_list(100)
+        # Una consulta por nivel con $in y unión en memoria: 4 viajes a Mongo sea cual sea el tamaño del árbol
+        macros = [normalize_id(m) for m in await db.macrociclos.find({"athlete_id": athlete_id}).to_list(None)]
+        macro_ids = [m["id"] for m in macros]
+
+        micros = []
+        if macro_ids:
+            micros = [normalize_id(mic) for mic in await db.microciclos.find({"macrociclo_id": {"$in": macro_ids}}).to_list(None)]
+        micro_ids = [mic["id"] for mic in micros]
+
+        workouts_by_micro = {micro_id: [] for micro_id in micro_ids}
+        if micro_ids:
+            async for w in db.workouts.find({"microciclo_id": {"$in": micro_ids}}):
+                workouts_by_micro[w["microciclo_id"]].append(normalize_id(w))
+
+        micros_by_macro = {macro_id: [] for macro_id in macro_ids}
+        for mic in micros:
+            mic["workouts"] = workouts_by_micro[mic["id"]]
+            micros_by_macro[mic["macrociclo_id"]].append(mic)
         for m in macros:
-            m["id"] = m.get("id", str(m.get("_id")))
-            m.pop('_id', None)
-            
-            m["microciclos"] = await db.microciclos.find({"macrociclo_id": m["id"]}).to_list(100)
-            for mic in m["microciclos"]:
-                mic["id"] = mic.get("id", str(mic.get("_id")))
-                mic.pop('_id', None)
-                
-                mic["workouts"] = await db.workouts.find({"microciclo_id": mic["id"]}).to_list(100)
-                for w in mic["workouts"]: 
-                    w["id"] = w.get("id", str(w.get("_id")))
-                    w.pop('_id', None)
-                    
-        unassigned = await db.workouts.find({"athlete_id": athlete_id, "microciclo_id": {"$in": [None, ""]}}).to_list(100)
-        for u in unassigned: 
-            u["id"] = u.get("id", str(u.get("_id")))
-            u.pop('_id', None)
-            
+            m["microciclos"] = micros_by_macro[m["id"]]
+
+        unassigned = [normalize_id(u) for u in await db.workouts.find({"athlete_id": athlete_id, "microciclo_id": {"$in": [None, ""]}}).to_list(None)]
+
         return {"macros": macros, "unassigned_workouts": unassigned}
     except Exception as e:
         return {"macros": [], "unassigned_workouts": [], "error": str(e)}
@@ -921,8 +3387,7 @@ async def delete_macro(macro_id: str, user=Depends(get_current_user)):
     if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
     await db.macrociclos.delete_one({"id": macro_id})
     
-    micros = await db.microciclos.find({"macrociclo_id": macro_id}).to_list(100)
-    micro_ids = [m["id"] for m in micros]
+    micro_ids = await db.microciclos.distinct("id", {"macrociclo_id": macro_id})
     await db.microciclos.delete_many({"macrociclo_id": macro_id})
     
     if micro_ids:
@@ -956,22 +3421,33 @@ async def delete_micro(micro_id: str, user=Depends(get_current_user)):
 @api_router.post("/tests")
 async def create_test(data: TestCreate, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
     test_doc = data.dict()
-    test_doc.update({"id": str(uuid.uuid4()), "created_at": datetime.now(timezone.utc).isoformat()})
+    test_doc.update({"id": str(uuid.uuid4()), "trainer_id": resolve_trainer_id(user), "created_at": datetime.now(timezone.utc).isoformat()})
     await db.tests.insert_one(test_doc)
     test_doc.pop('_id', None)
     
     if user.get('role') == 'athlete' and user.get('trainer_id'):
-        trainer = await db.users.find_one({"id": user['trainer_id']})
+        trainer = await get_cached_user(user['trainer_id'])
         if trainer and trainer.get('web_push_subscription'):
             nombre_test = (data.custom_name if data.custom_name else data.test_name).upper()
             background_tasks.add_task(send_web_push, trainer['web_push_subscription'], "📏 Nuevo registro físico", f"{user.get('name')} ha registrado: {nombre_test} ({data.value} {data.unit})")
     return {"status": "success", "test": test_doc}
 
 @api_router.get("/tests")
-async def get_tests(athlete_id: Optional[str] = None, test_type: Optional[str] = None, user=Depends(get_current_user)):
-    query = {'athlete_id': user['id']} if user['role'] == 'athlete' else ({'athlete_id': athlete_id} if athlete_id else {})
+async def get_tests(
+    athlete_id: Optional[str] = None,
+    test_type: Optional[str] = None,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user=Depends(get_current_user)
+):
+    query = scoped_athlete_query(user, athlete_id)
     if test_type and test_type != 'all': query['test_type'] = test_type
-    return await db.tests.find(query, {"_id": 0}).sort("date", -1).to_list(1000)
+    apply_date_range(query, date_from, date_to)
+    if limit or cursor:
+        return await paginate_by_date(db.tests, query, {"_id": 0}, limit or 50, cursor)
+    return await db.tests.find(query, {"_id": 0}).sort([("date", -1), ("id", -1)]).to_list(1000)
 
 @api_router.delete("/tests/{test_id}")
 async def delete_test(test_id: str, user=Depends(get_current_user)):
@@ -1065,9 +3541,147 @@ async def upload_file(request: Request, file: UploadFile = File(...), user=Depen
         logger.error(f"Error subida general: {str(e)}")
         raise HTTPException(status_code=500, detail="Fallo al procesar archivo")
         
+# --- MÉTRICAS INTERNAS ---
+@api_router.get("/system/stats")
+async def get_system_stats(user=Depends(get_current_user)):
+    if user['role'] != 'trainer': raise HTTPException(status_code=403, detail="No autorizado")
+    return {"user_cache": USER_CACHE.stats(), "password_hashing": password_stats(), "google_verifier": GOOGLE_VERIFIER.stats, "llm_provider": LLM_PROVIDER.stats(), "brain_cache": BRAIN_CACHE.summary(), "brain_jobs": {**BRAIN_JOB_STATS, "workers": BRAIN_JOB_WORKERS}, "brain_latency": {phase: samples.summary() for phase, samples in BRAIN_LATENCY.items()}, "analytics_memo": ANALYTICS_MEMO_STATS, "conversations": CONVERSATION_STATS, "ai_parsing": AI_PARSE_STATS, "brain_memory_index": BRAIN_MEMORY_INDEX.summary()}
+
 app.include_router(api_router)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
+# --- COMANDOS DE MANTENIMIENTO ---
+# Uso: python server.py <comando>
+async def cmd_check_indexes():
+    await ensure_indexes()
+    failures = await verify_query_plans()
+    for failure in failures:
+        print(f"COLLSCAN: {failure}")
+    print(f"{len(QUERY_SHAPES) - len(failures)}/{len(QUERY_SHAPES)} consultas usan índice.")
+    return 1 if failures else 0
+
+async def cmd_backfill_trainer_ids(batch_size: int = 500):
+    """Migración única: copia el trainer_id del atleta en sus workouts y tests antiguos, por lotes."""
+    modified = {"workouts": 0, "tests": 0}
+
+    async def flush(batch):
+        for collection_name in modified:
+            ops = [UpdateMany({"athlete_id": a['id'], "trainer_id": {"$exists": False}}, {"$set": {"trainer_id": a['trainer_id']}}) for a in batch]
+            result = await db[collection_name].bulk_write(ops, ordered=False)
+            modified[collection_name] += result.modified_count
+
+    batch = []
+    async for athlete in db.users.find({"role": "athlete", "trainer_id": {"$exists": True}}, {"_id": 0, "id": 1, "trainer_id": 1}):
+        batch.append(athlete)
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    print(f"trainer_id rellenado en {modified['workouts']} workouts y {modified['tests']} tests.")
+    return 0
+
+async def cmd_compact_brain_memory(batch_size: int = 500):
+    """Migración única: agrupa las entradas antiguas de brain_memory por entrenador y contenido.
+
+    El trainer_id de una entrada antigua se deduce de los workouts con el mismo título; si el título
+    aparece en varios entrenadores la entrada queda sin asignar (no se comparte entre ellos).
+    Después conviene ejecutar reconcile-brain-counters.
+    """
+    scanned, skipped, batch = 0, 0, []
+    title_owner = {}
+
+    async def owner_of(title):
+        if title not in title_owner:
+            owners = await db.workouts.distinct("trainer_id", {"title": title, "trainer_id": {"$ne": None}})
+            title_owner[title] = owners[0] if len(owners) == 1 else None
+        return title_owner[title]
+
+    async for doc in db.brain_memory.find({"$or": [{"content_hash": {"$exists": False}}, {"trainer_id": {"$exists": False}}]}):
+        scanned += 1
+        trainer_id = await owner_of(doc.get('title'))
+        if trainer_id is None and doc.get('content_hash'):
+            skipped += 1  # ya compactada y sin dueño claro: se deja como está
+            continue
+        learned_at = doc.get('learned_at') or datetime.now(timezone.utc).isoformat()
+        content_hash = doc.get('content_hash') or brain_memory_hash(doc.get('title'), doc.get('exercises'))
+        batch.append(brain_memory_upsert(trainer_id, content_hash, {**doc, "learned_at": learned_at},
+                                         uses=doc.get('usage_count', 1), first_learned_at=doc.get('first_learned_at') or learned_at))
+        batch.append(DeleteOne({"_id": doc['_id']}))
+        if len(batch) >= batch_size * 2:
+            await db.brain_memory.bulk_write(batch, ordered=True)
+            batch = []
+    if batch:
+        await db.brain_memory.bulk_write(batch, ordered=True)
+    total = await db.brain_memory.count_documents({})
+    print(f"{scanned} entradas antiguas revisadas ({skipped} sin entrenador identificable). brain_memory tiene ahora {total} entradas únicas.")
+    return 0
+
+async def cmd_reconcile_brain_counters():
+    """Recalcula brain_memory_counters desde brain_memory. Mejor en horas valle: un $inc concurrente se pisaría."""
+    actual = {}
+    async for row in db.brain_memory.aggregate([
+        {"$match": {"trainer_id": {"$ne": None}}},
+        {"$group": {"_id": "$trainer_id", "total": {"$sum": 1}}},
+    ]):
+        actual[row['_id']] = row['total']
+    stored = {c['_id']: c.get('total', 0) async for c in db.brain_memory_counters.find({}, {"total": 1})}
+    now = datetime.now(timezone.utc).isoformat()
+    ops = [
+        UpdateOne({"_id": trainer_id}, {"$set": {"total": actual.get(trainer_id, 0), "updated_at": now}}, upsert=True)
+        for trainer_id in set(actual) | set(stored)
+        if actual.get(trainer_id, 0) != stored.get(trainer_id)
+    ]
+    if ops:
+        await db.brain_memory_counters.bulk_write(ops, ordered=False)
+    print(f"{len(ops)} contadores corregidos de {len(set(actual) | set(stored))} entrenadores.")
+    return 0
+
+async def cmd_rebuild_athlete_stats(batch_size: int = 200):
+    """Recalcula athlete_stats de todos los atletas por lotes y sustituye lo guardado."""
+    rebuilt, drifted = 0, 0
+    fields = ("total_workouts", "completed_workouts", "latest_wellness_date", "last_activity_at", "is_injured", "injury_notes", "equipment")
+
+    async def flush(athletes):
+        nonlocal rebuilt, drifted
+        ids = [a['id'] for a in athletes]
+        computed, current = await asyncio.gather(
+            compute_athlete_stats_batch(athletes),
+            db.athlete_stats.find({"_id": {"$in": ids}}).to_list(None),
+        )
+        current = {c['_id']: c for c in current}
+        for athlete_id, stats in computed.items():
+            old = current.get(athlete_id)
+            if old is not None and any(old.get(f) != stats.get(f) for f in fields):
+                drifted += 1
+        await db.athlete_stats.bulk_write([ReplaceOne({"_id": i}, st, upsert=True) for i, st in computed.items()], ordered=False)
+        rebuilt += len(computed)
+
+    batch = []
+    async for athlete in db.users.find({"role": "athlete"}, ATHLETE_STATS_USER_FIELDS):
+        batch.append(athlete)
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    print(f"athlete_stats reconstruido para {rebuilt} atletas ({drifted} tenían deriva).")
+    return 0
+
+MAINTENANCE_COMMANDS = {
+    "check-indexes": cmd_check_indexes,
+    "backfill-trainer-ids": cmd_backfill_trainer_ids,
+    "compact-brain-memory": cmd_compact_brain_memory,
+    "reconcile-brain-counters": cmd_reconcile_brain_counters,
+    "rebuild-athlete-stats": cmd_rebuild_athlete_stats,
+}
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        command = MAINTENANCE_COMMANDS.get(sys.argv[1])
+        if not command:
+            print(f"Comando desconocido: {sys.argv[1]}. Disponibles: {', '.join(MAINTENANCE_COMMANDS)}")
+            sys.exit(2)
+        sys.exit(asyncio.run(command()) or 0)
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
@@ -0,0 +1,117 @@
+"""AI response parsing unit tests (no live server needed)"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "fit_tracker_test")
+os.environ.setdefault("JWT_SECRET", "test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+DAYS = ["2026-10-19", "2026-10-21", "2026-10-23"]
+
+
+def microcycle_request():
+    return server.MicrocycleGenerateRequest(athlete_id="athlete-1", fecha_inicio=DAYS[0], fecha_fin=DAYS[-1])
+
+
+class TestRepairJson:
+    """Truncated output is closed without keeping half-written values"""
+
+    def test_clean_json_is_not_repaired(self):
+        assert server.repair_json('```json\n{"a": 1}\n```') == ({"a": 1}, False)
+
+    def test_trailing_commas_are_removed(self):
+        assert server.repair_json('{"a": [1, 2,],}') == ({"a": [1, 2]}, True)
+
+    def test_truncated_string_value_is_dropped_with_its_key(self):
+        raw = '{"exercises": [{"name": "Peso muerto", "sets": "3", "reps": "10-1'
+        value, repaired = server.repair_json(raw)
+        assert repaired
+        assert value == {"exercises": [{"name": "Peso muerto", "sets": "3"}]}
+
+    def test_truncated_key_is_dropped(self):
+        assert server.repair_json('{"a": "x", "na')[0] == {"a": "x"}
+
+    def test_truncated_array_element_is_dropped(self):
+        assert server.repair_json('{"recommendations": ["Descansa", "Hidrat')[0] == {"recommendations": ["Descansa"]}
+        assert server.repair_json('{"a": [1, 2')[0] == {"a": [1]}
+
+    def test_truncated_nested_object_is_dropped(self):
+        assert server.repair_json('{"exercises": [{"name": "Remo"}, {')[0] == {"exercises": [{"name": "Remo"}]}
+        assert server.repair_json('{"exercises": [{"name": "Remo"}, {"na')[0] == {"exercises": [{"name": "Remo"}]}
+        assert server.repair_json('{"a": 1, "b": {"c": "pa')[0] == {"a": 1}
+
+    def test_partial_literal_is_dropped(self):
+        assert server.repair_json('{"a": 1, "b": tru')[0] == {"a": 1}
+
+
+class TestParseAiResponse:
+    def test_exercises_without_name_are_dropped(self):
+        raw = '{"workoutData": {"title": "Fuerza", "exercises": [{"name": "Sentadilla"}, {"sets": "3"}]}}'
+        result = server.parse_ai_response(raw, server.WorkoutAIResponse)
+        assert result["workoutData"]["exercises"] == [{"name": "Sentadilla"}]
+
+    def test_invalid_response_is_rejected(self):
+        with pytest.raises(HTTPException) as exc:
+            server.parse_ai_response("no es json", server.WorkoutAIResponse)
+        assert exc.value.status_code == 500
+
+    def test_truncated_response_is_rejected_when_not_allowed(self):
+        raw = '{"sessions": [{"day": 1, "title": "A", "exercises": [{"name": "Remo", "reps": "1'
+        with pytest.raises(HTTPException) as exc:
+            server.parse_ai_response(raw, server.MicrocycleAIResponse, allow_truncated=False)
+        assert exc.value.status_code == 502
+
+
+class TestValidateMicrocycleSessions:
+    """The whole week is accepted or rejected at once"""
+
+    def session(self, **overrides):
+        return {"day": 1, "title": "Fuerza", "exercises": [{"name": "Sentadilla"}], **overrides}
+
+    def validate(self, sessions):
+        return server.validate_microcycle_sessions({"sessions": sessions}, DAYS, microcycle_request())
+
+    def test_string_day_is_coerced(self):
+        workouts = self.validate([self.session(day="2"), self.session(day=1)])
+        assert [w.date for w in workouts] == DAYS[:2]
+
+    @pytest.mark.parametrize("day", [None, "lunes", True, 1.5])
+    def test_invalid_day_rejects_the_week(self, day):
+        with pytest.raises(HTTPException) as exc:
+            self.validate([self.session(), self.session(day=day)])
+        assert exc.value.status_code == 502
+
+    def test_missing_day_rejects_the_week(self):
+        session = self.session()
+        del session["day"]
+        with pytest.raises(HTTPException) as exc:
+            self.validate([session])
+        assert exc.value.status_code == 502
+
+    def test_repeated_or_out_of_range_day_rejects_the_week(self):
+        for sessions in ([self.session(), self.session()], [self.session(day=len(DAYS) + 1)]):
+            with pytest.raises(HTTPException) as exc:
+                self.validate(sessions)
+            assert exc.value.status_code == 502
+
+    def test_non_dict_session_rejects_the_week(self):
+        with pytest.raises(HTTPException) as exc:
+            self.validate([self.session(), "sesión"])
+        assert exc.value.status_code == 502
+
+    def test_missing_title_gets_a_default(self):
+        session = self.session()
+        del session["title"]
+        assert self.validate([session])[0].title == "Sesión 1"
+
+    def test_exercise_without_name_rejects_the_week(self):
+        with pytest.raises(HTTPException) as exc:
+            self.validate([self.session(exercises=[{"name": "Remo"}, {"sets": "3"}])])
+        assert exc.value.status_code == 502
@@ -82,3 +82,38 @@ class TestAnalyticsAPI:
         print(f"Analytics no auth response: {response.status_code}")
         
         assert response.status_code in [401, 403]
+
+    def test_analytics_summary_tracks_workout_writes(self, base_url, api_client, auth_headers, athlete_with_data):
+        """Test the summary counters follow create/complete/delete of a workout"""
+        def summary():
+            response = api_client.get(
+                f"{base_url}/api/analytics/summary?athlete_id={athlete_with_data['id']}",
+                headers=auth_headers
+            )
+            assert response.status_code == 200
+            return response.json()
+
+        before = summary()
+        workout = api_client.post(
+            f"{base_url}/api/workouts",
+            json={
+                "athlete_id": athlete_with_data["id"],
+                "date": datetime.now(timezone.utc).strftime('%Y-%m-%d'),
+                "title": "Stats Workout",
+                "exercises": [{"name": "Lunges", "sets": "3", "reps": "8"}]
+            },
+            headers=auth_headers
+        )
+        assert workout.status_code == 200
+        assert summary()["total_workouts"] == before["total_workouts"] + 1
+
+        workouts = api_client.get(f"{base_url}/api/workouts?athlete_id={athlete_with_data['id']}", headers=auth_headers).json()
+        workout_id = next(w["id"] for w in workouts if w["title"] == "Stats Workout")
+        api_client.put(f"{base_url}/api/workouts/{workout_id}", json={"completed": True}, headers=auth_headers)
+        after_complete = summary()
+        assert after_complete["completed_workouts"] == before["completed_workouts"] + 1
+
+        api_client.delete(f"{base_url}/api/workouts/{workout_id}", headers=auth_headers)
+        after_delete = summary()
+        assert after_delete["total_workouts"] == before["total_workouts"]
+        assert after_delete["completed_workouts"] == before["completed_workouts"]
@@ -115,3 +115,39 @@ class TestAuthMe:
         print(f"Auth me invalid token response: {response.status_code} - {response.text}")
         
         assert response.status_code == 401
+
+
+class TestAuthRefresh:
+    """Test POST /api/auth/refresh - only active when the server runs with AUTH_MODE=stateless"""
+
+    @pytest.fixture(scope="class")
+    def login_data(self, base_url, api_client, test_trainer_credentials):
+        response = api_client.post(f"{base_url}/api/auth/login", json=test_trainer_credentials)
+        assert response.status_code == 200
+        data = response.json()
+        if "refresh_token" not in data:
+            pytest.skip("Server is not running in stateless auth mode")
+        return data
+
+    def test_refresh_rotates_tokens(self, base_url, api_client, login_data):
+        """Test a refresh token yields a new working pair and cannot be reused"""
+        response = api_client.post(f"{base_url}/api/auth/refresh", json={"refresh_token": login_data["refresh_token"]})
+        print(f"Refresh response: {response.status_code} - {response.text}")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["refresh_token"] != login_data["refresh_token"]
+        assert data["expires_in"] > 0
+
+        me = api_client.get(f"{base_url}/api/auth/me", headers={"Authorization": f"Bearer {data['token']}"})
+        assert me.status_code == 200
+        assert "password" not in me.json()["user"]
+
+        reused = api_client.post(f"{base_url}/api/auth/refresh", json={"refresh_token": login_data["refresh_token"]})
+        assert reused.status_code == 401
+
+    def test_refresh_token_rejected_as_bearer(self, base_url, api_client, login_data):
+        """Test a refresh token cannot be used to call protected endpoints"""
+        headers = {"Authorization": f"Bearer {login_data['refresh_token']}"}
+        response = api_client.get(f"{base_url}/api/auth/me", headers=headers)
+        assert response.status_code == 401
@@ -0,0 +1,72 @@
+"""ModelRouter unit tests (no live server needed)"""
+import asyncio
+import os
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "fit_tracker_test")
+os.environ.setdefault("JWT_SECRET", "test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def router(monkeypatch):
+    """Fresh router with the Pro circuit breaker always closed"""
+    async def allow():
+        return True
+    monkeypatch.setattr(server.PRO_BREAKER, "allow_request", allow)
+    return server.ModelRouter([server.MODEL_PRO_ID, server.MODEL_FLASH_ID])
+
+
+def choose_many(router, n, request_class="batch"):
+    return [asyncio.run(router.choose(request_class)) for _ in range(n)]
+
+
+class TestModelRouter:
+    """Pro must be able to come back after being routed around"""
+
+    def test_pro_is_probed_while_error_rate_is_high(self, router):
+        for _ in range(server.ROUTER_MIN_SAMPLES):
+            router.record(server.MODEL_PRO_ID, 1.0, ok=False)
+
+        decisions = choose_many(router, 100)
+        reasons = [d["reason"] for d in decisions]
+        assert "pro_error_rate" in reasons
+        probes = [d for d in decisions if d["reason"] == "pro_probe"]
+        assert probes and all(d["model_id"] == server.MODEL_PRO_ID for d in probes)
+
+    def test_pro_recovers_after_successful_probes(self, router):
+        for _ in range(server.ROUTER_MIN_SAMPLES):
+            router.record(server.MODEL_PRO_ID, 1.0, ok=False)
+        assert choose_many(router, 1)[0]["model_id"] == server.MODEL_FLASH_ID
+
+        # Successful probe calls push the error rate back under the threshold
+        for _ in range(server.ROUTER_MIN_SAMPLES + 1):
+            router.record(server.MODEL_PRO_ID, 1.0, ok=True)
+        decision = choose_many(router, 1)[0]
+        assert decision["model_id"] == server.MODEL_PRO_ID
+        assert decision["reason"] == "default"
+
+    def test_old_errors_expire(self, router):
+        stale = time.monotonic() - server.ROUTER_SAMPLE_TTL_SECONDS - 1
+        router.outcomes[server.MODEL_PRO_ID] = deque(
+            [(stale, False)] * server.ROUTER_MIN_SAMPLES, maxlen=server.ROUTER_WINDOW
+        )
+        decision = choose_many(router, 1)[0]
+        assert decision["model_id"] == server.MODEL_PRO_ID
+
+    def test_slow_pro_is_probed_for_interactive_traffic(self, router):
+        slow_seconds = server.ROUTER_INTERACTIVE_P95_MS / 1000 * 2
+        for _ in range(server.ROUTER_MIN_SAMPLES):
+            router.record(server.MODEL_PRO_ID, slow_seconds, ok=True)
+
+        reasons = [d["reason"] for d in choose_many(router, 100, "interactive")]
+        assert "pro_slow" in reasons
+        assert "pro_probe" in reasons
@@ -231,3 +231,65 @@ class TestCSVWorkouts:
         print(f"CSV upload no auth response: {response.status_code}")
         
         assert response.status_code in [401, 403]
+
+
+class TestWorkoutsPagination:
+    """Test keyset pagination and date-range filters on GET /api/workouts"""
+
+    @pytest.fixture(scope="class")
+    def seeded_athlete(self, base_url, api_client, auth_headers, test_athlete):
+        """Create 5 workouts on consecutive days for the test athlete"""
+        workouts = [
+            {
+                "athlete_id": test_athlete["id"],
+                "date": f"2030-03-0{day}",
+                "title": f"TEST_Paged_{day}",
+                "exercises": [{"name": "Squats", "sets": "3", "reps": "10"}]
+            }
+            for day in range(1, 6)
+        ]
+        response = api_client.post(
+            f"{base_url}/api/workouts/bulk",
+            json={"workouts": workouts},
+            headers=auth_headers
+        )
+        assert response.status_code == 200
+        return test_athlete
+
+    def test_pages_follow_cursor_without_gaps(self, base_url, api_client, auth_headers, seeded_athlete):
+        """Test walking all pages with next_cursor returns every workout once, newest first"""
+        params = {"athlete_id": seeded_athlete["id"], "from": "2030-03-01", "to": "2030-03-05", "limit": 2}
+        seen = []
+        while True:
+            response = api_client.get(f"{base_url}/api/workouts", params=params, headers=auth_headers)
+            assert response.status_code == 200
+            page = response.json()
+            assert len(page["items"]) <= 2
+            seen.extend(w["date"] for w in page["items"])
+            if not page["next_cursor"]:
+                break
+            params["cursor"] = page["next_cursor"]
+
+        assert seen == ["2030-03-05", "2030-03-04", "2030-03-03", "2030-03-02", "2030-03-01"]
+
+    def test_date_range_without_exercises(self, base_url, api_client, auth_headers, seeded_athlete):
+        """Test from/to filter and include_exercises=false projection"""
+        response = api_client.get(
+            f"{base_url}/api/workouts",
+            params={"athlete_id": seeded_athlete["id"], "from": "2030-03-02", "to": "2030-03-03", "include_exercises": "false"},
+            headers=auth_headers
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert isinstance(data, list)
+        assert sorted(w["date"] for w in data) == ["2030-03-02", "2030-03-03"]
+        assert all("exercises" not in w for w in data)
+
+    def test_invalid_cursor_rejected(self, base_url, api_client, auth_headers, seeded_athlete):
+        """Test a malformed cursor returns 400"""
+        response = api_client.get(
+            f"{base_url}/api/workouts",
+            params={"athlete_id": seeded_athlete["id"], "cursor": "not-a-cursor"},
+            headers=auth_headers
+        )
+        assert response.status_code == 400
@@ -260,18 +260,14 @@ export default function HomeScreen() {
     if (!isSilent) setRefreshing(true);
     try {
       if (isTrainer) {
-        const data = await api.getAthletes();
-        const athletesWithReadiness = await Promise.all(
-          data.map(async (athlete: any) => {
-            try {
-              const summ = await api.getSummary(athlete.id);
-              const readiness = calculateReadiness(summ.latest_wellness);
-              return { ...athlete, ...readiness };
-            } catch (e) {
-              return { ...athlete, readinessColor: 'GRAY', readinessLabel: 'Sin datos', fatigue: 0, soreness: 0, sleep: 0 };
-            }
-          })
-        );
+        // Roster + panel en dos peticiones, en lugar de un resumen por atleta
+        const [data, dashboard] = await Promise.all([api.getAthletes(), api.getTrainerDashboard().catch(() => null)]);
+        const summaries = new Map<string, any>((dashboard?.athletes || []).map((a: any) => [a.id, a]));
+        const athletesWithReadiness = data.map((athlete: any) => {
+          const summ = summaries.get(athlete.id);
+          if (!summ) return { ...athlete, readinessColor: 'GRAY', readinessLabel: 'Sin datos', fatigue: 0, soreness: 0, sleep: 0 };
+          return { ...athlete, ...calculateReadiness(summ.latest_wellness) };
+        });
         setAthletes(athletesWithReadiness);
       } else {
         const [wData, sData, treeData, wellnessData] = await Promise.all([
@@ -72,7 +72,15 @@ export const api = {
   },
 
   // --- IA / GEMINI ---
-  generateWorkout: async (data: { userMessage: string; athleteContext: any; chatHistory: any[] }) => {
+  createConversation: async (data: { athlete_id?: string; athleteContext: any }) => {
+    const headers = await getAuthHeaders();
+    const res = await authFetch(`${BACKEND_URL}/api/brain/conversations`, {
+      method: 'POST', headers, body: JSON.stringify(data),
+    });
+    return res.json();
+  },
+
+  generateWorkout: async (data: { userMessage: string; athleteContext: any; chatHistory: any[]; athlete_id?: string; conversation_id?: string }) => {
     const headers = await getAuthHeaders();
     const res = await authFetch(`${BACKEND_URL}/api/brain/generate-workout`, {
       method: 'POST', headers, body: JSON.stringify(data),
@@ -149,6 +157,21 @@ export const api = {
     }
   },
 
+  getTrainerDashboard: async (params: { sort?: string; order?: 'asc' | 'desc'; injured?: boolean; has_session_today?: boolean; min_fatigue?: number } = {}) => {
+    const headers = await getAuthHeaders();
+    const query = new URLSearchParams(Object.entries(params).filter(([, v]) => v !== undefined).map(([k, v]) => [k, String(v)])).toString();
+    const url = `${BACKEND_URL}/api/trainer/dashboard${query ? `?${query}` : ''}`;
+    try {
+      const res = await authFetch(url, { headers });
+      const data = await res.json();
+      await syncManager.cacheData('trainer_dashboard', data);
+      return data;
+    } catch (e) {
+      if (shouldFallbackToOffline(e)) return await syncManager.getCachedData('trainer_dashboard') || { athletes: [] };
+      throw e;
+    }
+  },
+
   // --- ATLETAS ---
   getAthletes: async () => {
     const headers = await getAuthHeaders();
@@ -41,6 +41,8 @@ export default function GeminiChatModal({
   ]);
   const [inputText, setInputText] = useState('');
   const [isTyping, setIsTyping] = useState(false);
+  // El historial vive en el servidor: solo enviamos el mensaje nuevo
+  const [conversationId, setConversationId] = useState<string | null>(null);
   const flatListRef = useRef<FlatList>(null);
 
   // <-- ESTADOS PARA PREGUNTAR LA FECHA -->
@@ -68,7 +70,19 @@ export default function GeminiChatModal({
     setIsTyping(true);
 
     try {
-      const chatHistory = messages
+      const context = athleteContext || { fatigue: 3, soreness: 3, cyclePhase: 'No definida' };
+      let convId = conversationId;
+      if (!convId) {
+        try {
+          const conv = await api.createConversation({ athlete_id: athleteId, athleteContext: context });
+          if (conv?.conversation_id) {
+            convId = conv.conversation_id;
+            setConversationId(convId);
+          }
+        } catch (e) { console.log("Aviso: sin conversación en servidor, se envía el historial completo."); }
+      }
+
+      const chatHistory = convId ? [] : messages
         .filter(m => m.id !== 'welcome-1')
         .map(m => ({
           role: m.role === 'assistant' ? 'model' : 'user',
@@ -77,9 +91,10 @@ export default function GeminiChatModal({
 
       const aiData = await api.generateWorkout({
           userMessage: currentInput,
-          athleteContext: athleteContext || { fatigue: 3, soreness: 3, cyclePhase: 'No definida' },
+          athleteContext: context,
           chatHistory: chatHistory,
-          athlete_id: athleteId
+          athlete_id: athleteId,
+          conversation_id: convId || undefined
       });
 
       const newAssistantMsg: ChatMessage = {